@@ -3,19 +3,61 @@
 # TODO: корректно обрабатывать создание меток на доске для разных потоков данных. Сейчас они затирают метки друг друга
 # TODO: добавить возможность управления работой через ключи командной строки
 
+import codecs
+import csv
 import datetime
+import io
+import json
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from array import array
 from collections import deque
+from contextlib import closing, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from os import getenv
 import requests
 from statistics import median, mean
+import numpy as np
 import pandas as pd
 from paramiko import SSHClient
 import psycopg2
+from psycopg2 import sql
+import pyarrow as pa
 import yaml
 
 HTTP_SERVER_CREDS = {"server_url": "localhost:21122/monitoring/infrastructure/using/summary/1",
-                     "prices_url": "localhost:21122/monitoring/infrastructure/using/prices",
+                     "prices_url": "localhost:21122/monitoring/infrastructure/using/prices/1",
                      "generate_data_by": "ssh",  # http, ssh
+                     "stream": 1,  # 1 - разбирать ответ сервера по мере получения, не загружая его целиком
+                     "stream_chunk_size": 65536,
+                     # text - запись на каждое наблюдение, dict - ресурс и измерение передаются один раз на серию
+                     "summary_format": "dict",
+                     # допустимое сжатие ответов сервера. zstd требует установленного пакета zstandard
+                     "accept_encoding": "gzip",
+                     "aggregation_engine": "numpy",  # python, numpy
+                     "aggregation_workers": 0,  # больше 1 - аггрегация частей данных в пуле процессов
+                     "prices_cache_filename": "prices_cache.sqlite3",  # локальный кэш стоимости ресурсов
+                     "prices_cache_ttl": 3600,  # сколько секунд использовать кэш без обращения к серверу
+                     "prices_format": "json",  # json, csv, yaml - предпочитаемый формат ответа со стоимостью
+                     # 1 - запрашивать только новые наблюдения и дополнять ими сохраненное состояние. Состояние
+                     # хранит окно последних наблюдений сервера, поэтому аггрегаты совпадают с полным сбором
+                     "incremental": 0,
+                     "incremental_state_filename": "incremental_state.pickle",
+                     # шаблон url для сбора данных нескольких филиалов классом MultiBranchCollector
+                     "branch_url": "localhost:21122/monitoring/infrastructure/using/summary/{company_branch}",
+                     # agent - аггрегация исходных наблюдений коллектором, server - готовые аггрегаты с aggregate_url
+                     "aggregate_by": "agent",
+                     "aggregate_url": "localhost:21122/monitoring/infrastructure/using/aggregate/1",
+                     # исходные данные в бинарном колоночном формате Arrow IPC для MetricsCollectorAgentArrow
+                     "arrow_url": "localhost:21122/monitoring/infrastructure/using/summary/1.arrow",
+                     "branch_prices_url": "localhost:21122/monitoring/infrastructure/using/prices/{company_branch}",
+                     "branch_aggregate_url": "localhost:21122/monitoring/infrastructure/using/aggregate/{company_branch}",
+                     "max_workers": 8,  # количество одновременно опрашиваемых филиалов
                      "debug": 1}
 
 
@@ -33,7 +75,34 @@ DB_SERVER_CREDS = {"db_type": "postgresql",
                    "db_base": "postgres",
                    "db_scheme": "usage_stats",
                    "db_user": "postgres",
-                   "db_password": "q1w2e3"
+                   "db_password": "q1w2e3",
+                   # database - аггрегаты вычисляются запросом по всей таблице наблюдений,
+                   # rollup - по таблицам накопленных аггрегатов, которые дополняются только новыми наблюдениями,
+                   # agent - исходные наблюдения загружаются и аггрегируются коллектором
+                   "aggregate_by": "database",
+                   # rollup: наблюдения учитываются в накопленных аггрегатах не раньше, чем через rollup_lag секунд
+                   # после фиксации границы по id и завершения транзакций, начатых до нее. Более новые наблюдения
+                   # аггрегируются запросом к таблице наблюдений при каждом сборе
+                   "rollup_lag": 60,
+                   # server - именованный курсор на стороне сервера БД, строки передаются порциями по itersize,
+                   # client - результат запроса целиком загружается в память коллектора
+                   "cursor": "server",
+                   "itersize": 2000,
+                   # 1 - при запуске создать индекс серий и секции таблицы наблюдений по месяцам collect_date
+                   "bootstrap_schema": 0,
+                   "partition_months_ahead": 3,  # на сколько месяцев вперед создавать секции
+                   # 1 - при запуске предупреждать о последовательном чтении таблицы наблюдений в плане запроса
+                   # с отбором по командам и ресурсам или выборки новых наблюдений rollup
+                   "explain_check": 0,
+                   # окно времени [since, until) по collect_date (datetime или строка 'YYYY-MM-DD') и списки команд
+                   # и ресурсов для частичного сбора. None - без ограничения
+                   "since": None,
+                   "until": None,
+                   "teams": None,
+                   "resources": None,
+                   # пул соединений, общий для всех агентов с одинаковыми параметрами подключения
+                   "pool_maxconn": 10,  # не больше pool_maxconn соединений, остальные агенты ожидают освобождения
+                   "pool_health_check_interval": 30  # соединение, простоявшее дольше, проверяется запросом select 1
                    }
 
 TRELLO_API_CREDS = {
@@ -41,6 +110,12 @@ TRELLO_API_CREDS = {
                     "boards_url": "1/members/me/boards",
                     "target_list": "Нужно сделать",
                     "target_board": "Управление ресурсами",
+                    "max_workers": 8,  # количество одновременно создаваемых карточек
+                    "rate_limit": 100,  # ограничение Trello: не более 100 запросов на токен
+                    "rate_period": 10,  # за 10 секунд
+                    "max_retries": 5,  # количество повторов запроса при ответе 429
+                    "retry_backoff": 1,  # начальная задержка перед повтором запроса, секунды
+                    "board_cache_ttl": 300,  # через сколько секунд полностью перечитывать объекты доски
                     "debug": 1
 }
 
@@ -86,6 +161,35 @@ class MetricsGenerator:
                 raise RuntimeError(f"Failed to generate data. Error: {self.generation_status}")
 
 
+class TokenBucket:
+    """
+    Ограничитель частоты запросов по алгоритму "ведро токенов"
+    не более rate запросов за period секунд, допускает всплеск до rate запросов подряд
+    может использоваться из нескольких потоков одновременно
+    """
+    def __init__(self, rate: int, period: float):
+        self.__capacity = rate  # максимальное количество токенов в ведре
+        self.__tokens = float(rate)  # текущее количество токенов
+        self.__fill_rate = rate / period  # скорость пополнения ведра, токенов в секунду
+        self.__updated = time.monotonic()  # время последнего пополнения ведра
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """
+        забирает из ведра один токен. Если токенов нет - ожидает их пополнения
+        """
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__fill_rate)
+                self.__updated = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.__fill_rate
+            time.sleep(wait)
+
+
 class TrelloConnector:
     """
     Обеспечивает подключение к сервису Trello с параметрами key, token из переменных окружения
@@ -98,6 +202,7 @@ class TrelloConnector:
     __CARDS = "cards"
 
     # константы HTTP-запросов
+    __STATUS_TOO_MANY_REQUESTS = 429
     __METHOD_POST = "POST"
     __METHOD_GET = "GET"
     __METHOD_DELETE = "DELETE"
@@ -117,11 +222,28 @@ class TrelloConnector:
         self.__target_list_id = None    # хранит id основного листа доски на котором будем работать
         self.__target_list_name = trello_creds.get("target_list")   # текстовое название основного листа
         self.__debug = bool(trello_creds.get("debug", 0))   # переменная-триггер для вывода отладочной информации
+        self.__max_workers = trello_creds.get("max_workers", 8)  # количество одновременно создаваемых карточек
+        self.__max_retries = trello_creds.get("max_retries", 5)  # количество повторов запроса при ответе 429
+        self.__retry_backoff = trello_creds.get("retry_backoff", 1)  # начальная задержка перед повтором запроса
+        # ограничитель частоты запросов ко всем методам API Trello
+        self.__rate_limiter = TokenBucket(trello_creds.get("rate_limit", 100), trello_creds.get("rate_period", 10))
+        # объекты основной доски хранятся локально и обновляются по ответам на запросы создания и удаления
+        # полностью перечитываются с доски по запросу или по истечении board_cache_ttl секунд
+        self.__board_cache_ttl = trello_creds.get("board_cache_ttl", 300)
+        self.__refreshed_at = {}  # время последнего полного перечитывания объектов доски по типам
 
     @property
     def session(self):
-        if self.__session is not None:
+        """
+        геттер для атрибута session
+        автоматически создает экземпляр session с пулом соединений по количеству потоков создания карточек
+        :return:
+        """
+        if self.__session is None:
             self.__session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.__max_workers)
+            self.__session.mount('http://', adapter)
+            self.__session.mount('https://', adapter)
         return self.__session
 
     def __enter__(self):
@@ -162,7 +284,18 @@ class TrelloConnector:
             **execute_params
         }
         query = execute_params.get("query_type", "Unknown query")
-        response = self.__session.request(method=execute_method, url=execute_url, params=params)
+        for attempt in range(self.__max_retries + 1):
+            self.__rate_limiter.acquire()
+            response = self.session.request(method=execute_method, url=execute_url, params=params)
+            if response.status_code != self.__STATUS_TOO_MANY_REQUESTS or attempt == self.__max_retries:
+                break
+            # превышен лимит запросов: ждем время из заголовка Retry-After или экспоненциально растущую задержку
+            try:
+                delay = float(response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                delay = self.__retry_backoff * 2 ** attempt
+            print(f"Лимит запросов: <{query}> повтор через {delay} с") if self.__debug else None
+            time.sleep(delay)
         if response.status_code == 200:
             print(f"Успех: <{query}> Метод: {execute_method} url: {execute_url}") if self.__debug else None
             return response
@@ -184,19 +317,21 @@ class TrelloConnector:
     def delete_objects_by_name(self, object_name_iterable, object_type: str):
         """
         удаляет с основной доски объекты заданного типа (labels, cards) находя их по текстовому названию
-        затем перечитывает информацию с основной доски об объектах заданного типа
+        и удаляет их из локального списка объектов основной доски
         :param object_name_iterable: список текстовых названий объекта
         :param object_type: тип объекта (labels, cards)
         :return:
         """
-        for object_name in object_name_iterable:
-            object_id = self.__target_board[object_type].get(object_name, None)
+        board_objects = self.__get_objects(object_type)
+        for object_name in list(object_name_iterable):
+            object_id = board_objects.get(object_name, None)
             if object_id is not None:
-                self.__execute_query(execute_method=self.__METHOD_DELETE,
-                                     execute_url=f"{self.__root_url}1/{object_type}/{object_id}",
-                                     execute_params={"query_type": f"delete object from {object_type}"})
-        # принудительно обновить список объектов основной доски после выполнения операции
-        self.__refresh_objects_list(object_type)
+                response = self.__execute_query(execute_method=self.__METHOD_DELETE,
+                                                execute_url=f"{self.__root_url}1/{object_type}/{object_id}",
+                                                execute_params={"query_type": f"delete object from {object_type}"})
+                # удалить объект из локального списка объектов основной доски
+                if response is not None:
+                    board_objects.pop(object_name, None)
 
     def __refresh_objects_list(self, object_type: str):
         """
@@ -206,6 +341,28 @@ class TrelloConnector:
         :return:
         """
         self.__target_board[object_type] = self.__get_board_items(self.__target_board["id"], object_type)
+        self.__refreshed_at[object_type] = time.monotonic()
+
+    def __get_objects(self, object_type: str):
+        """
+        возвращает локальный список объектов основной доски заданного типа в виде {name: id}
+        перечитывает его с доски, если истекло время хранения board_cache_ttl
+        :param object_type: тип объектов (lists, labels, cards)
+        :return:
+        """
+        if time.monotonic() - self.__refreshed_at.get(object_type, 0) > self.__board_cache_ttl:
+            self.__refresh_objects_list(object_type)
+        return self.__target_board[object_type]
+
+    def refresh_board(self):
+        """
+        принудительно перечитывает все объекты основной доски (lists, labels, cards)
+        например, если доска могла быть изменена кем-то еще
+        :return:
+        """
+        self.__refresh_objects_list(self.__LISTS)
+        self.__refresh_objects_list(self.__LABELS)
+        self.__refresh_objects_list(self.__CARDS)
 
     @staticmethod
     def __object_generator(iterable_object):
@@ -245,9 +402,7 @@ class TrelloConnector:
                         "id": board_params["id"],
                         "name": board
                     }
-                    self.__refresh_objects_list(self.__LISTS)
-                    self.__refresh_objects_list(self.__LABELS)
-                    self.__refresh_objects_list(self.__CARDS)
+                    self.refresh_board()
 
     def __set_main_list(self):
         """
@@ -255,7 +410,7 @@ class TrelloConnector:
         все дальнейшие действия экземпляра TrelloConnector будут выполняться в этом листе
         :return: ничего не возвращает. А надо бы
         """
-        for item, item_dict in self.__target_board[self.__LISTS].items():
+        for item, item_dict in self.__get_objects(self.__LISTS).items():
             if item == self.__target_list_name:
                 self.__target_list_id = item_dict
                 break
@@ -267,45 +422,74 @@ class TrelloConnector:
         :param object_type: тип объекта
         :return: возвращает True - объект существует, False - объект не существует, None - доска не доступна/не создана
         """
-        return bool(object_name in self.__target_board[object_type])
+        return bool(object_name in self.__get_objects(object_type))
+
+    def __create_card(self, params: dict):
+        """
+        создает в Trello одну карточку задачи. Выполняется в потоке пула
+        :param params: параметры создаваемой карточки
+        :return: возвращает результат запроса (response) или None
+        """
+        return self.__execute_query(execute_method=self.__METHOD_POST,
+                                    execute_url=f"{self.__root_url}1/cards",
+                                    execute_params=params)
 
     def add_cards(self, cards: list):
         """
-        создает в Trello карточку задачи. Если карточка с таким названием уже есть на основном листе - она не создастся
+        создает в Trello карточки задач. Если карточка с таким названием уже есть на основном листе - она не создастся
+        карточки создаются параллельно в пуле потоков с учетом ограничения частоты запросов Trello
         :param cards: список словарей подготовленных заданий с параметрами, необходимыми для создания карточек Trello
-        :return:
+        :return: возвращает статистику создания карточек в виде словаря
+        {'created': количество, 'failed': количество, 'seconds': длительность, 'cards_per_second': скорость}
         """
+        stats = {"created": 0, "failed": 0, "seconds": 0.0, "cards_per_second": 0.0}
         if self.__target_board is not None and self.__target_list_id is not None:
+            board_labels = self.__get_objects(self.__LABELS)
+            cards_params = []
             for card in cards:
                 card_name = card["name"]
                 if not self.__check_object_exists_by_name(card_name, self.__CARDS):
-                    params = {
+                    cards_params.append({
                                 "name": card_name,
                                 "desc": card["desc"],
                                 "due": card["due"],
-                                "idLabels": self.__target_board[self.__LABELS].get(card.get("label", ""), ""),
+                                "idLabels": board_labels.get(card.get("label", ""), ""),
                                 "idList": self.__target_list_id,
                                 "query_type": "create card"
-                             }
-                    self.__execute_query(execute_method=self.__METHOD_POST,
-                                         execute_url=f"{self.__root_url}1/cards",
-                                         execute_params=params)
-            self.__refresh_objects_list(self.__CARDS)
+                             })
+            started = time.monotonic()
+            board_cards = self.__get_objects(self.__CARDS)
+            with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+                for response in executor.map(self.__create_card, cards_params):
+                    if response is not None:
+                        stats["created"] += 1
+                        # добавить созданную карточку в локальный список карточек основной доски
+                        created_card = response.json()
+                        board_cards[created_card["name"]] = created_card["id"]
+                    else:
+                        stats["failed"] += 1
+            stats["seconds"] = round(time.monotonic() - started, 3)
+            if stats["seconds"]:
+                stats["cards_per_second"] = round(stats["created"] / stats["seconds"], 1)
+            print(f"Создано карточек: {stats['created']}, ошибок: {stats['failed']}, "
+                  f"время: {stats['seconds']} с, скорость: {stats['cards_per_second']} карточек/с") \
+                if self.__debug else None
+        return stats
 
     def delete_cards_by_name(self, labels_name_iterable):
         """
-        Удаляет метку с заданным текстовым именем с основной доски и перечитывает оставшиеся метки
+        Удаляет метку с заданным текстовым именем с основной доски
         :param labels_name_iterable: список названий меток для удаления
         :return:
         """
         self.delete_objects_by_name(labels_name_iterable, self.__CARDS)
 
     def delete_cards_all(self):
-        self.delete_cards_by_name(self.__object_generator(self.__target_board[self.__CARDS]))
+        self.delete_cards_by_name(self.__object_generator(self.__get_objects(self.__CARDS)))
 
     def add_label(self, labels: list):
         """
-        создает метку с заданым названием и цветом, затем перечитывает метки основной доски
+        создает метку с заданым названием и цветом и добавляет ее в локальный список меток основной доски
         цвет метки каруселится по списку __LABEL_COLORS
         :param labels: список текстовых наименований меток
         :return:
@@ -317,11 +501,13 @@ class TrelloConnector:
                       "color": label_color,
                       "query_type": "add label"
                       }
-            self.__execute_query(execute_method=self.__METHOD_POST,
-                                 execute_url=f"{self.__root_url}1/boards/{self.__target_board['id']}/labels",
-                                 execute_params=params)
-        # обновить список меток после добавления
-        self.__refresh_objects_list(self.__LABELS)
+            response = self.__execute_query(execute_method=self.__METHOD_POST,
+                                            execute_url=f"{self.__root_url}1/boards/{self.__target_board['id']}/labels",
+                                            execute_params=params)
+            # обновить список меток после добавления
+            if response is not None:
+                created_label = response.json()
+                self.__get_objects(self.__LABELS)[created_label["name"]] = created_label["id"]
 
     def delete_labels_by_name(self, label_name_iterable):
         """
@@ -330,14 +516,481 @@ class TrelloConnector:
         :return:
         """
         self.delete_objects_by_name(label_name_iterable, self.__LABELS)
-        self.__refresh_objects_list(self.__LABELS)
 
     def delete_labels_all(self):
         """
         удаляет все метки с основной доски Trello
         :return:
         """
-        self.delete_labels_by_name(self.__object_generator(self.__target_board[self.__LABELS]))
+        self.delete_labels_by_name(self.__object_generator(self.__get_objects(self.__LABELS)))
+
+
+class RawDataStore:
+    """
+    Компактное хранилище исходных наблюдений
+    названия команд, ресурсов и измерений хранятся один раз и заменяются числовыми кодами,
+    метки времени (секунды от начала эпохи) и значения каждой серии (команда, ресурс, измерение)
+    хранятся в непрерывных массивах array('q') и array('d')
+    пакеты серий в плоских массивах numpy (например, столбцы пакета Arrow) хранятся без копирования
+    и аггрегируются по отдельности, пока серии не повторяются в разных пакетах
+    """
+    # начало эпохи для перевода меток времени в целые числа. Метки времени считаются заданными в UTC
+    _EPOCH = datetime.datetime(1970, 1, 1)
+    _SECOND = datetime.timedelta(seconds=1)
+
+    def __init__(self, unique_timestamps: bool = True):
+        self.__unique_timestamps = unique_timestamps  # оставлять в серии одно наблюдение на метку времени
+        self.__codes = {}   # словарь соответствия названий числовым кодам
+        self.__names = []   # названия по числовому коду
+        self.__series = {}  # {(team_code, resource_code, dimension_code): (array('q'), array('d'))}
+        self.__last_key = None  # ключ последней серии. Записи одной серии обычно идут подряд
+        self.__last_series = None
+        self.__batches = []  # пакеты серий без копирования: [(keys, lengths, timestamps, values)]
+
+    def __len__(self):
+        self.__merge_batches()
+        return len(self.__series)
+
+    def __get_code(self, name: str):
+        """
+        возвращает числовой код названия, при необходимости регистрирует новое название
+        :param name: название команды, ресурса или измерения
+        :return:
+        """
+        code = self.__codes.get(name)
+        if code is None:
+            code = self.__codes[name] = len(self.__names)
+            self.__names.append(name)
+        return code
+
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def timestamp_to_epoch(timestamp: str):
+        """
+        переводит метку времени вида "%Y-%m-%d %H:%M:%S" в секунды от начала эпохи
+        метки времени в исходных данных многократно повторяются, поэтому результат кэшируется
+        :param timestamp: метка времени в текстовом виде
+        :return:
+        """
+        return (datetime.datetime.fromisoformat(timestamp) - RawDataStore._EPOCH) // RawDataStore._SECOND
+
+    @classmethod
+    def datetime_to_epoch(cls, value):
+        """
+        переводит дату или дату и время в секунды от начала эпохи
+        :param value: datetime.date или datetime.datetime
+        :return:
+        """
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime.combine(value, datetime.time())
+        return (value.replace(tzinfo=None) - cls._EPOCH) // cls._SECOND
+
+    @classmethod
+    def epoch_to_datetime(cls, epoch: int):
+        """
+        переводит секунды от начала эпохи в datetime.datetime
+        :param epoch: метка времени в секундах от начала эпохи
+        :return:
+        """
+        return cls._EPOCH + datetime.timedelta(seconds=int(epoch))
+
+    def append(self, team: str, resource_id: str, dimension: str, epoch: int, value: float):
+        """
+        добавляет одно наблюдение в серию (команда, ресурс, измерение)
+        :param team: название команды
+        :param resource_id: идентификатор ресурса
+        :param dimension: наблюдаемая метрика ресурса
+        :param epoch: метка времени наблюдения в секундах от начала эпохи
+        :param value: значение наблюдения
+        """
+        self.__merge_batches()
+        series = self.__get_series(team, resource_id, dimension)
+        series[0].append(epoch)
+        series[1].append(value)
+
+    def extend(self, team: str, resource_id: str, dimension: str, epochs, values):
+        """
+        добавляет несколько наблюдений в серию (команда, ресурс, измерение)
+        :param team: название команды
+        :param resource_id: идентификатор ресурса
+        :param dimension: наблюдаемая метрика ресурса
+        :param epochs: метки времени наблюдений в секундах от начала эпохи, итерируемый объект или массив numpy
+        :param values: значения наблюдений в том же порядке, итерируемый объект или массив numpy
+        """
+        self.__merge_batches()
+        series = self.__get_series(team, resource_id, dimension)
+        if isinstance(epochs, np.ndarray):
+            # массивы numpy копируются в серию целиком, без перебора элементов
+            series[0].frombytes(epochs.astype(np.int64, copy=False).tobytes())
+            series[1].frombytes(values.astype(np.float64, copy=False).tobytes())
+        else:
+            series[0].extend(epochs)
+            series[1].extend(values)
+
+    def extend_batch(self, keys: list, lengths, timestamps, values):
+        """
+        добавляет пакет серий, которые идут подряд в плоских массивах numpy, без копирования массивов
+        :param keys: ключи (team, resource_id, dimension) серий пакета
+        :param lengths: количество наблюдений в каждой серии пакета
+        :param timestamps: метки времени всех серий пакета подряд, массив int64
+        :param values: значения всех серий пакета подряд, массив любого числового типа
+        """
+        self.__batches.append((keys, np.asarray(lengths, dtype=np.int64), timestamps, values))
+
+    def __merge_batches(self):
+        """
+        копирует серии пакетов в массивы серий хранилища. Нужно, когда серия продолжается в другом пакете
+        или серии перебираются по одной
+        """
+        batches, self.__batches = self.__batches, []
+        for keys, lengths, timestamps, values in batches:
+            ends = np.cumsum(lengths).tolist()
+            for (team, resource_id, dimension), start, end in zip(keys, [0] + ends[:-1], ends):
+                self.extend(team, resource_id, dimension, timestamps[start:end], values[start:end])
+
+    def __batches_are_separate(self):
+        """
+        проверяет, что пакеты можно аггрегировать по отдельности: каждая серия целиком находится в одном пакете
+        и, если в серии оставляется одно наблюдение на метку времени, метки времени в сериях возрастают
+        """
+        if self.__series:
+            return False
+        keys_count = sum(len(keys) for keys, _, _, _ in self.__batches)
+        if len({key for keys, _, _, _ in self.__batches for key in keys}) != keys_count:
+            return False
+        if self.__unique_timestamps:
+            for _, lengths, timestamps, _ in self.__batches:
+                not_increasing = np.diff(timestamps) <= 0
+                not_increasing[np.cumsum(lengths)[:-1] - 1] = False
+                if np.any(not_increasing):
+                    return False
+        return True
+
+    def __get_series(self, team: str, resource_id: str, dimension: str):
+        """
+        возвращает массивы серии (команда, ресурс, измерение), при необходимости создает новую серию
+        :return: кортеж (array('q'), array('d'))
+        """
+        key = (team, resource_id, dimension)
+        if key != self.__last_key:
+            code_key = (self.__get_code(team), self.__get_code(resource_id), self.__get_code(dimension))
+            series = self.__series.get(code_key)
+            if series is None:
+                series = self.__series[code_key] = (array('q'), array('d'))
+            self.__last_key, self.__last_series = key, series
+        return self.__last_series
+
+    @staticmethod
+    def _get_unique(timestamps, values):
+        """
+        оставляет для каждой метки времени только первое наблюдение, как это делал словарь исходных данных
+        наблюдения серии обычно идут по возрастанию времени, поэтому сначала проверяется только это,
+        без копирования массивов. Повторы ищутся лишь в сериях, где метки времени не возрастают
+        :param timestamps: массив меток времени серии
+        :param values: массив значений серии
+        :return:
+        """
+        epochs = np.frombuffer(timestamps, dtype=np.int64)
+        if not np.any(np.diff(epochs) <= 0):
+            return timestamps, values
+        _, first_positions = np.unique(epochs, return_index=True)
+        if len(first_positions) == len(epochs):
+            return timestamps, values
+        first_positions.sort()
+        unique_timestamps, unique_values = array('q'), array('d')
+        unique_timestamps.frombytes(epochs[first_positions].tobytes())
+        unique_values.frombytes(np.frombuffer(values, dtype=np.float64)[first_positions].tobytes())
+        return unique_timestamps, unique_values
+
+    def teams(self):
+        """
+        возвращает названия команд в порядке их появления в исходных данных
+        """
+        return list(dict.fromkeys([*(self.__names[team_code] for team_code, _, _ in self.__series),
+                                   *(team for keys, _, _, _ in self.__batches for team, _, _ in keys)]))
+
+    def to_segments(self):
+        """
+        собирает все серии в плоские массивы, в которых серии идут подряд друг за другом
+        :return: кортеж (keys, lengths, timestamps, values), где keys - список ключей (team, resource_id, dimension),
+        lengths - количество наблюдений в каждой серии
+        """
+        self.__merge_batches()
+        keys, lengths, timestamps, values = [], array('q'), array('q'), array('d')
+        for (team_code, resource_code, dimension_code), (series_timestamps, series_values) in self.__series.items():
+            keys.append((self.__names[team_code], self.__names[resource_code], self.__names[dimension_code]))
+            lengths.append(len(series_timestamps))
+            timestamps.extend(series_timestamps)
+            values.extend(series_values)
+        if self.__unique_timestamps:
+            lengths, timestamps, values = self._get_unique_segments(lengths, timestamps, values)
+        return keys, lengths, timestamps, values
+
+    @classmethod
+    def _get_unique_segments(cls, lengths, timestamps, values):
+        """
+        оставляет в каждой серии плоских массивов только первое наблюдение на метку времени
+        серии, в которых метки времени возрастают, находятся одним сравнением соседних меток по всем массивам
+        и не копируются. Повторы ищутся только в остальных сериях
+        :param lengths: количество наблюдений в каждой серии
+        :param timestamps: метки времени всех серий подряд
+        :param values: значения всех серий подряд
+        :return: кортеж (lengths, timestamps, values)
+        """
+        epochs = np.frombuffer(timestamps, dtype=np.int64)
+        not_increasing = np.diff(epochs) <= 0
+        ends = np.cumsum(np.frombuffer(lengths, dtype=np.int64))
+        # сравнение последней метки серии с первой меткой следующей серии не учитывается
+        not_increasing[ends[:-1] - 1] = False
+        if not np.any(not_increasing):
+            return lengths, timestamps, values
+        keep = np.ones(len(epochs), dtype=bool)
+        unique_lengths = array('q', lengths)
+        for segment in np.unique(np.searchsorted(ends, np.flatnonzero(not_increasing), side='right')):
+            start, end = int(ends[segment - 1]) if segment else 0, int(ends[segment])
+            _, first_positions = np.unique(epochs[start:end], return_index=True)
+            keep[start:end] = False
+            keep[start + first_positions] = True
+            unique_lengths[segment] = len(first_positions)
+        unique_timestamps, unique_values = array('q'), array('d')
+        unique_timestamps.frombytes(epochs[keep].tobytes())
+        unique_values.frombytes(np.frombuffer(values, dtype=np.float64)[keep].tobytes())
+        return unique_lengths, unique_timestamps, unique_values
+
+    def to_shards(self, shards_count: int):
+        """
+        разбивает серии на части по хэшу идентификатора ресурса. Все серии одного ресурса попадают в одну часть
+        каждая часть представлена плоскими массивами array, которые дешево передаются в другой процесс
+        :param shards_count: количество частей
+        :return: список кортежей (positions, keys, lengths, timestamps, values), где positions - порядковые номера
+        серий части среди всех серий хранилища
+        """
+        self.__merge_batches()
+        shards = [([], [], array('q'), array('q'), array('d')) for _ in range(shards_count)]
+        for position, (team, resource_id, dimension, series_timestamps, series_values) in enumerate(self.series()):
+            positions, keys, lengths, timestamps, values = shards[hash(resource_id) % shards_count]
+            positions.append(position)
+            keys.append((team, resource_id, dimension))
+            lengths.append(len(series_timestamps))
+            timestamps.extend(series_timestamps)
+            values.extend(series_values)
+        return [shard for shard in shards if shard[0]]
+
+    @staticmethod
+    def aggregate_segments(lengths, timestamps, values):
+        """
+        вычисляет медиану, среднее и максимальную метку времени сразу для всех серий за один проход
+        значения сортируются внутри серий одной сортировкой по ключу (номер серии, значение),
+        медиана берется из середины каждой отсортированной серии
+        :param lengths: количество наблюдений в каждой серии
+        :param timestamps: метки времени всех серий подряд
+        :param values: значения всех серий подряд, array('d') или массив numpy любого числового типа.
+        Значения не приводятся к float64, чтобы не копировать их
+        :return: кортеж массивов numpy (medians, means, max_timestamps)
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if not len(lengths):
+            return np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values)
+        starts = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=starts[1:])
+        segment_ids = np.repeat(np.arange(len(lengths)), lengths)
+        sorted_values = values[np.lexsort((values, segment_ids))]
+        medians = np.add(sorted_values[starts + (lengths - 1) // 2], sorted_values[starts + lengths // 2],
+                         dtype=np.float64) / 2
+        means = np.add.reduceat(values, starts, dtype=np.float64) / lengths
+        max_timestamps = np.maximum.reduceat(timestamps, starts)
+        return medians, means, max_timestamps
+
+    def aggregate(self):
+        """
+        вычисляет аггрегаты всех серий хранилища векторизованно
+        пакеты, в которых серии не продолжаются в других пакетах, аггрегируются по отдельности без копирования
+        :return: кортеж (keys, medians, means, max_timestamps)
+        """
+        if self.__batches and self.__batches_are_separate():
+            keys, aggregates = [], []
+            for batch_keys, lengths, timestamps, values in self.__batches:
+                keys.extend(batch_keys)
+                aggregates.append(self.aggregate_segments(lengths, timestamps, values))
+            return (keys, *(np.concatenate(columns) for columns in zip(*aggregates)))
+        keys, lengths, timestamps, values = self.to_segments()
+        return (keys, *self.aggregate_segments(lengths, timestamps, values))
+
+    def series(self):
+        """
+        генератор серий наблюдений в порядке их появления в исходных данных
+        :return: кортежи (team, resource_id, dimension, timestamps, values)
+        """
+        self.__merge_batches()
+        for (team_code, resource_code, dimension_code), (timestamps, values) in self.__series.items():
+            if self.__unique_timestamps:
+                timestamps, values = self._get_unique(timestamps, values)
+            yield self.__names[team_code], self.__names[resource_code], self.__names[dimension_code], timestamps, values
+
+
+class PricesCache:
+    """
+    Локальный кэш стоимости ресурсов в файле SQLite
+    словарь стоимости хранится по url запроса в сериализованном виде вместе с заголовками ETag и Last-Modified,
+    которые используются для проверки актуальности кэша условным запросом к серверу
+    """
+    def __init__(self, filename: str, ttl: int):
+        self.__filename = filename  # имя файла кэша
+        self.__ttl = ttl  # время, в течение которого кэш считается актуальным без обращения к серверу, секунды
+        with closing(sqlite3.connect(self.__filename)) as connection, connection:
+            connection.execute("""create table if not exists prices (
+                                        url text primary key,
+                                        etag text,
+                                        last_modified text,
+                                        fetched_at real,
+                                        prices blob)""")
+
+    def get(self, url: str):
+        """
+        возвращает запись кэша по url
+        :param url: url запроса стоимости ресурсов
+        :return: словарь {'prices': dict, 'etag': str, 'last_modified': str, 'expired': bool} или None
+        """
+        with closing(sqlite3.connect(self.__filename)) as connection:
+            record = connection.execute("select etag, last_modified, fetched_at, prices from prices where url = ?",
+                                        (url,)).fetchone()
+        if record is None:
+            return None
+        etag, last_modified, fetched_at, prices = record
+        return {"prices": pickle.loads(prices),
+                "etag": etag,
+                "last_modified": last_modified,
+                "expired": time.time() - fetched_at > self.__ttl}
+
+    def put(self, url: str, prices: dict, etag=None, last_modified=None):
+        """
+        сохраняет в кэш словарь стоимости ресурсов, полученный по url
+        :param url: url запроса стоимости ресурсов
+        :param prices: словарь стоимости ресурсов
+        :param etag: значение заголовка ETag ответа сервера
+        :param last_modified: значение заголовка Last-Modified ответа сервера
+        """
+        with closing(sqlite3.connect(self.__filename)) as connection, connection:
+            connection.execute("insert or replace into prices values (?, ?, ?, ?, ?)",
+                               (url, etag, last_modified, time.time(),
+                                pickle.dumps(prices, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def touch(self, url: str):
+        """
+        продлевает время актуальности записи кэша, если сервер подтвердил, что данные не изменились
+        :param url: url запроса стоимости ресурсов
+        """
+        with closing(sqlite3.connect(self.__filename)) as connection, connection:
+            connection.execute("update prices set fetched_at = ? where url = ?", (time.time(), url))
+
+
+class IncrementalState:
+    """
+    Сохраняемое между запусками состояние инкрементального сбора данных из одного источника (url):
+    курсор - метка времени последнего полученного наблюдения, окно - промежуток времени от первого до последнего
+    наблюдения в полном ответе сервера, и по каждой серии (команда, ресурс, измерение) наблюдения этого окна
+    наблюдения старше окна вытесняются, поэтому аггрегаты совпадают с аггрегатами полного сбора,
+    который получает от сервера только последние max_observations наблюдений
+    состояния разных источников хранятся в одном файле по ключу url
+    """
+    __file_lock = threading.Lock()  # файл состояния может использоваться агентами из разных потоков
+
+    def __init__(self, filename: str, url: str):
+        self.__filename = filename  # имя файла состояния
+        self.__url = url  # url источника данных
+        self.cursor = None  # курсор для запроса только новых наблюдений
+        self.__window = None  # окно наблюдений сервера, секунды
+        self.__series = {}  # {(team, resource_id, dimension): (array('q'), array('d'))}
+        with self.__file_lock:
+            state = self.__load_all().get(self.__url)
+        # состояние прежнего формата, без окна, не используется: следующий запрос получит всю историю
+        if state is not None and "window" in state:
+            self.cursor, self.__window, self.__series = state["cursor"], state["window"], state["series"]
+
+    def __load_all(self):
+        """
+        читает состояния всех источников из файла
+        :return: словарь {url: {'cursor': cursor, 'window': window, 'series': series}}
+        """
+        try:
+            with open(self.__filename, 'rb') as state_file:
+                return pickle.load(state_file)
+        except FileNotFoundError:
+            return {}
+
+    def save(self):
+        """
+        сохраняет состояние источника в файл. Файл заменяется целиком, чтобы не повредить его при сбое записи
+        """
+        with self.__file_lock:
+            states = self.__load_all()
+            states[self.__url] = {"cursor": self.cursor, "window": self.__window, "series": self.__series}
+            with open(f"{self.__filename}.tmp", 'wb') as state_file:
+                pickle.dump(states, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{self.__filename}.tmp", self.__filename)
+
+    def reset(self):
+        """
+        очищает состояние источника
+        """
+        self.cursor = None
+        self.__window = None
+        self.__series = {}
+
+    def merge(self, raw_data_store, cursor):
+        """
+        дополняет состояние серий новыми наблюдениями и вытесняет наблюдения старше окна сервера
+        без сохраненного курсора ответ содержит всю историю сервера, по нему определяется окно
+        :param raw_data_store: хранилище RawDataStore с новыми наблюдениями
+        :param cursor: курсор ответа сервера - метка времени последнего наблюдения
+        """
+        first_timestamp = None
+        for team, resource_id, dimension, timestamps, values in raw_data_store.series():
+            series = self.__series.get((team, resource_id, dimension))
+            if series is None:
+                series = self.__series[(team, resource_id, dimension)] = (array('q'), array('d'))
+            series[0].extend(timestamps)
+            series[1].extend(values)
+            if self.cursor is None:
+                first_timestamp = min(first_timestamp if first_timestamp is not None else timestamps[0],
+                                      min(timestamps))
+        if self.cursor is None and first_timestamp is not None:
+            self.__window = cursor - first_timestamp
+        self.cursor = cursor
+        if self.__window is not None:
+            self.__evict(cursor - self.__window)
+
+    def __evict(self, first_timestamp: int):
+        """
+        удаляет наблюдения старше first_timestamp и серии, в которых не осталось наблюдений
+        :param first_timestamp: метка времени самого раннего наблюдения окна
+        """
+        for key, (timestamps, values) in list(self.__series.items()):
+            epochs = np.frombuffer(timestamps, dtype=np.int64)
+            if not len(epochs) or epochs.min() >= first_timestamp:
+                continue
+            keep = epochs >= first_timestamp
+            if not keep.any():
+                del self.__series[key]
+                continue
+            kept_timestamps, kept_values = array('q'), array('d')
+            kept_timestamps.frombytes(epochs[keep].tobytes())
+            kept_values.frombytes(np.frombuffer(values, dtype=np.float64)[keep].tobytes())
+            self.__series[key] = (kept_timestamps, kept_values)
+
+    def aggregate(self):
+        """
+        вычисляет медиану, среднее и максимальную метку времени по каждой серии состояния
+        :return: кортеж (keys, medians, means, max_timestamps)
+        """
+        keys, lengths, timestamps, values = list(self.__series), array('q'), array('q'), array('d')
+        for series_timestamps, series_values in self.__series.values():
+            lengths.append(len(series_timestamps))
+            timestamps.extend(series_timestamps)
+            values.extend(series_values)
+        return (keys, *RawDataStore.aggregate_segments(lengths, timestamps, values))
 
 
 class MetricsCollectorAgent:
@@ -392,17 +1045,64 @@ class MetricsCollectorAgent:
     # __METRIC_RESOURCE_COST = 1006
     __METRIC_DIMENSION_COST = 1007
 
-    def __init__(self, server_creds: dict):
+    # разделители исходных данных: "$" - между командами, "|" - после названия команды, ";" - между записями
+    _RECORD_SEPARATORS = re.compile(r'[$|;]')
+
+    # заголовок ответа сервера с курсором для инкрементального сбора
+    _CURSOR_HEADER = 'X-Monitoring-Cursor'
+    # заголовок ответа сервера с форматом исходных данных. Без заголовка данные в формате text
+    _FORMAT_HEADER = 'X-Monitoring-Format'
+
+    # константы HTTP-ответов
+    __STATUS_OK = 200
+    __STATUS_NOT_MODIFIED = 304
+
+    # заголовки Accept для запроса стоимости ресурсов. yaml остается запасным форматом
+    __PRICES_ACCEPT = {
+        'json': 'application/json, application/x-yaml;q=0.5',
+        'csv': 'text/csv, application/x-yaml;q=0.5',
+        'yaml': 'application/x-yaml'
+    }
+
+    def __init__(self, server_creds: dict, http_session=None):
         self._request_type = 'http'  # тип/протокол запроса
         self.__url = server_creds['server_url']  # url источника данных без указания типа
         self._debug = bool(server_creds.get('debug', 0))  # переменная для режима отладки
         self.__full_url = f"{self._request_type}://{self.__url}"  # пременная с типом и запросом
         self.__prices_url = f"{self._request_type}://{server_creds['prices_url']}"  # url стоимости затрат на ресурсы
         self._response = None  # результат запроса в исхдном виде
-        self._raw_data_dict = None  # результат преобразования списка с словарь
+        self._raw_data_dict = None  # хранилище исходных наблюдений RawDataStore
         self._aggregated_data_dict = {}  # результат обработки данных
-        self.__http_session = None      # хранит экземпляр класса session для http-сессии
+        self.__http_session = http_session  # хранит экземпляр класса session для http-сессии
         self.__prices_dict = {}         # словарь стоимости затрат на наблюдаемые ресурсы
+        self._stream = bool(server_creds.get('stream', 0))  # режим потокового разбора ответа сервера
+        # python - аггрегация каждой серии по очереди, numpy - векторизованная аггрегация всех серий сразу
+        self._aggregation_engine = server_creds.get('aggregation_engine', 'python')
+        # количество процессов для параллельной аггрегации. 0 или 1 - аггрегация в текущем процессе
+        self._aggregation_workers = server_creds.get('aggregation_workers', 0)
+        self.__prices_accept = self.__PRICES_ACCEPT[server_creds.get('prices_format', 'yaml')]
+        # локальный кэш стоимости ресурсов. Без указания имени файла стоимость запрашивается каждый раз
+        self.__prices_cache = None
+        if server_creds.get('prices_cache_filename'):
+            self.__prices_cache = PricesCache(server_creds['prices_cache_filename'],
+                                              server_creds.get('prices_cache_ttl', 3600))
+        self.__stream_chunk_size = server_creds.get('stream_chunk_size', 65536)  # размер блока чтения ответа
+        # состояние инкрементального сбора. В этом режиме сервер отдает только наблюдения новее курсора
+        self.__incremental_state = None
+        if server_creds.get('incremental', 0):
+            self.__incremental_state = IncrementalState(
+                server_creds.get('incremental_state_filename', 'incremental_state.pickle'), self.__full_url)
+        self.__response_cursor = None  # курсор из заголовка ответа сервера
+        # agent - аггрегация исходных наблюдений, server - аггрегаты вычисляются сервером
+        self.__aggregate_by = server_creds.get('aggregate_by', 'agent')
+        if self.__aggregate_by == 'server':
+            self.__aggregate_url = f"{self._request_type}://{server_creds['aggregate_url']}"
+        self.__summary_format = server_creds.get('summary_format', 'text')  # запрашиваемый формат исходных данных
+        self.__response_format = None  # формат исходных данных в ответе сервера
+        # заголовки запросов к серверу. Сжатый ответ распаковывается библиотекой requests
+        self._request_headers = {}
+        if server_creds.get('accept_encoding'):
+            self._request_headers['Accept-Encoding'] = server_creds['accept_encoding']
 
     @property
     def http_session(self):
@@ -420,26 +1120,76 @@ class MetricsCollectorAgent:
         перегрузка для сбора информации из указанного источника на старте обращения к экземпляру класса
         :return: возвращает ссылку на себя
         """
-        self._response = self.__http_request(url=self.__full_url)
+        if self.__aggregate_by == 'server':
+            self._response = self.__http_request(url=self.__aggregate_url)
+            return self
+        params = {}
+        if self.__summary_format != 'text':
+            params['format'] = self.__summary_format
+        if self.__incremental_state is not None and self.__incremental_state.cursor is not None:
+            params['since'] = self.__incremental_state.cursor
+        if self._stream:
+            self._response = self.__http_stream_request(url=self.__full_url, params=params)
+        else:
+            self._response = self.__http_request(url=self.__full_url, params=params)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._stream and self.__aggregate_by == 'agent' and self._response is not None:
+            # закрыть генератор, чтобы освободить соединение, если ответ не был дочитан
+            self._response.close()
         self._response = None
         print("Работа парсера завершена") if self._debug else None
 
-    def __http_request(self, url: str, method='GET'):
+    def __http_request(self, url: str, method='GET', params=None):
         """
         выполнение http-запроса к северу по мере работы объекта класса
         :param url: ресурс доступа по HTTP
         :param method: метод доступа
+        :param params: параметры запроса
         :return:  результат выполнения HTTP-запроса или исключение
         """
-        response = self.http_session.request(method=method, url=url)
-        if response.status_code == 200:
+        response = self.http_session.request(method=method, url=url, params=params, headers=self._request_headers)
+        if response.status_code == self.__STATUS_OK:
+            self.__response_cursor = response.headers.get(self._CURSOR_HEADER)
+            self.__response_format = response.headers.get(self._FORMAT_HEADER, 'text')
             return response.text
         else:
             raise RuntimeError(f"Не удалось получить данные из {url}. Ошибка: {response.status_code}")
 
+    def __http_stream_request(self, url: str, method='GET', params=None):
+        """
+        выполнение http-запроса к серверу без загрузки тела ответа в память целиком
+        :param url: ресурс доступа по HTTP
+        :param method: метод доступа
+        :param params: параметры запроса
+        :return: генератор текстовых блоков тела ответа или исключение
+        """
+        response = self.http_session.request(method=method, url=url, params=params, headers=self._request_headers,
+                                             stream=True)
+        if response.status_code == self.__STATUS_OK:
+            self.__response_cursor = response.headers.get(self._CURSOR_HEADER)
+            self.__response_format = response.headers.get(self._FORMAT_HEADER, 'text')
+            return self._get_stream_chunks(response, self.__stream_chunk_size)
+        else:
+            response.close()
+            raise RuntimeError(f"Не удалось получить данные из {url}. Ошибка: {response.status_code}")
+
+    @staticmethod
+    def _get_stream_chunks(response, chunk_size: int):
+        """
+        генератор текстовых блоков тела ответа. Байты декодируются инкрементально, поэтому символ,
+        разрезанный границей блока, не теряется
+        :param response: ответ сервера, полученный с параметром stream=True
+        :param chunk_size: размер блока чтения в байтах
+        :return:
+        """
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+        with response:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                yield decoder.decode(chunk)
+            yield decoder.decode(b'', final=True)
+
     @staticmethod
     def _items_generator(iterable):
         """
@@ -468,93 +1218,301 @@ class MetricsCollectorAgent:
         """
         return record.strip("()").split(',')
 
+    @staticmethod
+    def _parse_series(series=''):
+        """
+        разбивает серию словарного формата "resource,dimension,start,step:usage,usage,..." на лексемы
+        метки времени наблюдений серии восстанавливаются по метке времени первого наблюдения и шагу
+        :param series: одна серия наблюдений ресурса по одному измерению
+        :return: кортеж (resource_id, resource_dimension, метки времени в секундах от начала эпохи, значения)
+        """
+        header, values = series.rsplit(':', 1)
+        resource_id, resource_dimension, start, step = header.split(',')
+        values = values.split(',')
+        start, step = int(start), int(step)
+        return resource_id, resource_dimension, range(start, start + step * len(values), step), values
+
+    @classmethod
+    def _get_stream_data(cls, chunks):
+        """
+        генератор для разделения потока текстовых блоков на элементы по разделителям "$", "|", ";"
+        по мере поступления блоков. В памяти хранится только текущий блок и незавершенный элемент
+        :param chunks: итерируемый объект с текстовыми блоками исходных данных
+        :return: пары (элемент, разделитель после элемента). Для последнего элемента разделитель - пустая строка
+        """
+        tail = ''
+        for chunk in chunks:
+            tail += chunk
+            start = 0
+            for match in cls._RECORD_SEPARATORS.finditer(tail):
+                yield tail[start:match.start()], match.group()
+                start = match.end()
+            tail = tail[start:]
+        yield tail, ''
+
+    def _get_stream_items(self, chunks):
+        """
+        генератор неразобранных записей исходных данных из потока текстовых блоков
+        :param chunks: итерируемый объект с текстовыми блоками исходных данных
+        :return: пары (team, запись)
+        """
+        team = None
+        for item, letter in self._get_stream_data(chunks):
+            if letter == '|':
+                team = item
+            elif team is not None and len(item) >= 2:
+                yield team, item
+
+    def _get_text_items(self, text: str):
+        """
+        генератор неразобранных записей исходных данных из ответа сервера, полученного целиком
+        :param text: ответ сервера
+        :return: пары (team, запись)
+        """
+        for item in self._get_data(text, '$'):
+            if len(item) < 2:
+                break
+            team, command_metrics_records = item.split('|')
+            for record in self._get_data(command_metrics_records, ';'):
+                if len(record) >= 2:
+                    yield team, record
+
+    def _get_items(self):
+        """
+        генератор неразобранных записей исходных данных в зависимости от режима получения ответа сервера
+        :return: пары (team, запись)
+        """
+        if self._stream:
+            return self._get_stream_items(self._response)
+        else:
+            return self._get_text_items(self._response)
+
+    def _get_records(self):
+        """
+        генератор записей исходных данных формата text
+        :return: записи в виде (team, resource_id, resource_dimension, metric_unique_id, metric_value)
+        """
+        for team, record in self._get_items():
+            yield (team, *self._parse_record(record))
+
+    def _get_series(self):
+        """
+        генератор серий исходных данных формата dict
+        :return: серии в виде (team, resource_id, resource_dimension, metric_timestamps, metric_values)
+        """
+        for team, series in self._get_items():
+            yield (team, *self._parse_series(series))
+
     def _get_raw_data_dict(self):
         """
-        преобразует с помощью генератора записи исходных данных в словарь вида
-        {'command':{'resource_id':{'dimension":{'metric_unique_id':value}}}}
-        metric_unique_id - для разных классов может быть разным объектом. Для HHTP - метка времени сбора информации,
-        для агента БД - уникальный номер строки (id) в БД
-        :return: возвращает распарсенный набор данных в виде словаря с записями по каждому событию
+        преобразует с помощью генератора записи исходных данных в компактное хранилище RawDataStore
+        с сериями наблюдений по ключу (команда, ресурс, измерение)
+        метка времени сбора информации переводится в секунды от начала эпохи, значение - в float
+        в потоковом режиме записи попадают в хранилище по мере чтения ответа сервера
+        :return: возвращает хранилище с записями по каждому событию
         """
         if self._response is not None:
-            records_dict = {}
-            for item in self._get_data(self._response, '$'):
-                if len(item) < 2:
-                    break
-                team, command_metrics_records = item.split('|')
-                records_dict[team] = records_dict.get(team, {})
-                for record in self._get_data(command_metrics_records, ';'):
-                    resource_id, resource_dimension, metric_unique_id, metric_value = self._parse_record(record)
-                    records_dict[team][resource_id] = \
-                        records_dict[team].get(resource_id, {})
-                    records_dict[team][resource_id][resource_dimension] = \
-                        records_dict[team][resource_id].get(resource_dimension, {})
-                    records_dict[team][resource_id][resource_dimension][metric_unique_id] = \
-                        records_dict[team][resource_id][resource_dimension].get(metric_unique_id, metric_value)
-            print('Данные собраны для команд:', records_dict.keys()) if self._debug else None
-            return records_dict
+            raw_data_store = RawDataStore()
+            if self.__response_format == 'dict':
+                for team, resource_id, resource_dimension, metric_timestamps, metric_values in self._get_series():
+                    raw_data_store.extend(team, resource_id, resource_dimension,
+                                          metric_timestamps, map(float, metric_values))
+            else:
+                for team, resource_id, resource_dimension, metric_timestamp, metric_value in self._get_records():
+                    raw_data_store.append(team, resource_id, resource_dimension,
+                                          RawDataStore.timestamp_to_epoch(metric_timestamp), float(metric_value))
+            print('Данные собраны для команд:', raw_data_store.teams()) if self._debug else None
+            return raw_data_store
         else:
             return None
 
-    def _get_data_usage_type(self, median_value: float, mean_value: float):
+    def _get_data_usage_type_array(self, median_values, mean_values):
         """
-        в соответствии условиям определяет для каждого типа аггрегированных данных состояние нагрузки
-        :param median_value: медиана набора данных
-        :param mean_value: среднее значение набора данных
-        :return: возвращает предопределенное значение, обозначающее состояние нагрузки
+        в соответствии условиям определяет сразу для набора серий состояние нагрузки
+        при нулевой медиане расхождение считается бесконечным (скачки), при нулевых медиане и среднем - стабильным
+        :param median_values: медианы серий
+        :param mean_values: средние значения серий
+        :return: возвращает массив предопределенных значений, обозначающих состояние нагрузки
         """
-        divergence = mean_value / median_value
-        if divergence < 0.75:
-            return self._USAGE_FALLING
-        elif divergence > 1.25:
-            return self._USAGE_RAISING
-        else:
-            return self._USAGE_STABLE
+        with np.errstate(divide='ignore', invalid='ignore'):
+            divergence = np.asarray(mean_values, dtype=np.float64) / np.asarray(median_values, dtype=np.float64)
+        return np.select([divergence < 0.75, divergence > 1.25],
+                         [self._USAGE_FALLING, self._USAGE_RAISING],
+                         self._USAGE_STABLE)
 
-    def _get_data_intensivity(self, median_value: float):
+    def _get_data_intensivity_array(self, median_values):
         """
-        в соответствии условиям определяет для каждого типа аггрегированных данных интенсивность использования
-        :param median_value: медина набора аггрегированных данных
-        :return: возвращает предопределенное значение, обозначающее интенсивность использования
+        в соответствии условиям определяет сразу для набора серий интенсивность использования
+        :param median_values: медианы серий
+        :return: возвращает массив предопределенных значений, обозначающих интенсивность использования
         """
-        if 0 < median_value <= 30:
-            return self._INTENSIVITY_LOW
-        elif median_value <= 60:
-            return self._INTENSIVITY_MEDIUM
-        elif median_value <= 90:
-            return self._INTENSIVITY_HIGH
-        else:
-            return self._INTENSIVITY_EXTREME
+        median_values = np.asarray(median_values, dtype=np.float64)
+        return np.select([(0 < median_values) & (median_values <= 30), median_values <= 60, median_values <= 90],
+                         [self._INTENSIVITY_LOW, self._INTENSIVITY_MEDIUM, self._INTENSIVITY_HIGH],
+                         self._INTENSIVITY_EXTREME)
 
-    def _get_usage_decision(self, intensivity, usage_type):
+    def _get_usage_decision_array(self, intensivity, usage_type):
         """
-        в соответствии условиям определяет для каждого типа аггрегированных данных текущее состояние объекта наблюдения
-        :param intensivity: интенсивность использования объекта
-        :param usage_type: состояние нагрузки объекта
-        :return: возвращает предопределенное значение, обозначающее текущее состояние объекта наблюдения
+        в соответствии условиям определяет сразу для набора серий текущее состояние объекта наблюдения
+        :param intensivity: массив интенсивностей использования
+        :param usage_type: массив состояний нагрузки
+        :return: возвращает массив предопределенных значений, обозначающих текущее состояние объектов наблюдения
         """
-        state = intensivity + usage_type
-        if 10 <= state < 20:
-            return self._DECISION_DELETE
-        elif state < 32:
-            return self._DECISION_NORMAL
-        else:
-            return self._DECISION_OVERLOAD
+        state = np.asarray(intensivity) + np.asarray(usage_type)
+        return np.select([(10 <= state) & (state < 20), state < 32],
+                         [self._DECISION_DELETE, self._DECISION_NORMAL],
+                         self._DECISION_OVERLOAD)
+
+    def _classify_usage(self, median_values, mean_values):
+        """
+        определяет состояние нагрузки, интенсивность использования и решение сразу для набора серий
+        :param median_values: медианы серий
+        :param mean_values: средние значения серий
+        :return: кортеж списков (usage_types, intensivities, decisions)
+        """
+        usage_types = self._get_data_usage_type_array(median_values, mean_values)
+        intensivities = self._get_data_intensivity_array(median_values)
+        decisions = self._get_usage_decision_array(intensivities, usage_types)
+        return usage_types.tolist(), intensivities.tolist(), decisions.tolist()
 
     def __get_resource_prices(self):
         """
         опрашивает сервер на предмет информации о стоимости обслуживания наблюдаемых ресурсов по направлениям
         наблюдения (CPU, RAM, NetFlow)
         метод должен запускаться только после сбора данных о наблюдениях
+        при включенном кэше в течение prices_cache_ttl секунд используется сохраненная стоимость,
+        затем ее актуальность проверяется условным запросом с заголовками If-None-Match/If-Modified-Since
         :return: возвращает словарь стоимости затрат на наблюдение за ресурсами в виде
         {resource_id: {'CPU': price, 'RAM': price, "NetFlow': price}}
         """
-        yaml_prices_string = yaml.safe_load(self.__http_request(url=self.__prices_url))
+        cached = self.__prices_cache.get(self.__prices_url) if self.__prices_cache is not None else None
+        if cached is not None and not cached["expired"]:
+            return cached["prices"]
+        headers = {**self._request_headers, "Accept": self.__prices_accept}
+        if cached is not None and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached is not None and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+        response = self.http_session.get(self.__prices_url, headers=headers)
+        if response.status_code == self.__STATUS_NOT_MODIFIED and cached is not None:
+            print('Стоимость ресурсов не изменилась') if self._debug else None
+            self.__prices_cache.touch(self.__prices_url)
+            return cached["prices"]
+        elif response.status_code == self.__STATUS_OK:
+            prices_dict = self._parse_prices(response.text, response.headers.get("Content-Type", ""))
+            if self.__prices_cache is not None:
+                self.__prices_cache.put(self.__prices_url, prices_dict,
+                                        response.headers.get("ETag"), response.headers.get("Last-Modified"))
+            return prices_dict
+        else:
+            raise RuntimeError(f"Не удалось получить данные из {self.__prices_url}. Ошибка: {response.status_code}")
+
+    @staticmethod
+    def _parse_prices(prices_text: str, content_type: str = ''):
+        """
+        разбирает ответ сервера со стоимостью ресурсов в формате, указанном в заголовке Content-Type
+        json и csv разбираются значительно быстрее yaml, yaml используется, если сервер не поддерживает другие форматы
+        :param prices_text: ответ сервера
+        :param content_type: значение заголовка Content-Type ответа сервера
+        :return: возвращает словарь стоимости затрат на наблюдение за ресурсами
+        """
+        if content_type.startswith('application/json'):
+            return json.loads(prices_text)["values"]
+        elif content_type.startswith('text/csv'):
+            rows = csv.reader(io.StringIO(prices_text))
+            dimensions = next(rows)[1:]
+            return {resource: dict(zip(dimensions, map(int, resource_prices))) for resource, *resource_prices in rows}
+        yaml_prices_string = yaml.safe_load(prices_text)
         prices_dict = {}
         for resource, resource_price in yaml_prices_string["values"].items():
             prices_dict.setdefault(resource, {**resource_price})
         return prices_dict
 
+    def __aggregate_series(self):
+        """
+        вычисляет медиану, среднее и максимальную метку времени по каждой серии хранилища по очереди
+        :return: кортеж списков (keys, medians, means, max_timestamps)
+        """
+        keys, medians, means, max_timestamps = [], [], [], []
+        for team, resource_id, dimension, timestamps, values_list in self._raw_data_dict.series():
+            keys.append((team, resource_id, dimension))
+            medians.append(median(values_list))
+            means.append(mean(values_list))
+            max_timestamps.append(max(timestamps))
+        return keys, medians, means, max_timestamps
+
+    def __aggregate_series_in_processes(self):
+        """
+        вычисляет аггрегаты серий в пуле процессов. Серии делятся на части по хэшу ресурса,
+        каждая часть аггрегируется векторизованно в отдельном процессе, результаты собираются в исходном порядке серий
+        :return: кортеж списков (keys, medians, means, max_timestamps)
+        """
+        shards = self._raw_data_dict.to_shards(self._aggregation_workers)
+        series_count = len(self._raw_data_dict)
+        keys = [None] * series_count
+        medians = [0.0] * series_count
+        means = [0.0] * series_count
+        max_timestamps = [0] * series_count
+        with ProcessPoolExecutor(max_workers=self._aggregation_workers) as executor:
+            results = executor.map(RawDataStore.aggregate_segments,
+                                   *zip(*((lengths, timestamps, values) for _, _, lengths, timestamps, values in shards)))
+            for (positions, shard_keys, _, _, _), (shard_medians, shard_means, shard_max_timestamps) in \
+                    zip(shards, results):
+                for position, key, median_value, mean_value, max_timestamp in \
+                        zip(positions, shard_keys, shard_medians.tolist(), shard_means.tolist(),
+                            shard_max_timestamps.tolist()):
+                    keys[position] = key
+                    medians[position] = median_value
+                    means[position] = mean_value
+                    max_timestamps[position] = max_timestamp
+        return keys, medians, means, max_timestamps
+
+    @staticmethod
+    def _parse_aggregate(aggregate_text: str):
+        """
+        разбирает ответ сервера с аггрегатами серий
+        :param aggregate_text: ответ в формате JSON со столбцами team, resource, dimension, median, mean, max_ts
+        :return: кортеж списков (keys, medians, means, max_timestamps)
+        """
+        keys, medians, means, max_timestamps = [], [], [], []
+        for team, resource_id, dimension, median_value, mean_value, max_timestamp in \
+                json.loads(aggregate_text)["values"]:
+            keys.append((team, resource_id, dimension))
+            medians.append(median_value)
+            means.append(mean_value)
+            max_timestamps.append(max_timestamp)
+        return keys, medians, means, max_timestamps
+
+    def __merge_incremental_state(self):
+        """
+        дополняет сохраненное состояние серий новыми наблюдениями и сохраняет его вместе с новым курсором
+        если сервер не вернул курсор, ответ содержит всю историю и состояние строится заново
+        :return: кортеж (keys, medians, means, max_timestamps) по всем сериям состояния
+        """
+        if self.__response_cursor is None:
+            self.__incremental_state.reset()
+        self.__incremental_state.merge(self._raw_data_dict, None if self.__response_cursor is None
+                                       else int(self.__response_cursor))
+        self.__incremental_state.save()
+        return self.__incremental_state.aggregate()
+
+    @staticmethod
+    def _get_dates_from_epoch(timestamps):
+        """
+        переводит метки времени в секундах от начала эпохи в даты
+        меток много, а различных дат среди них мало, поэтому дата для каждого дня вычисляется один раз
+        :param timestamps: итерируемый объект с метками времени
+        :return: список дат datetime.date
+        """
+        dates = {}
+        result = []
+        for day in (int(timestamp) // 86400 for timestamp in timestamps):
+            date = dates.get(day)
+            if date is None:
+                date = dates[day] = RawDataStore.epoch_to_datetime(day * 86400).date()
+            result.append(date)
+        return result
+
     def get_aggregated_data_dict(self):
         """
         производит аггрегацию значений и
@@ -573,41 +1531,45 @@ class MetricsCollectorAgent:
         }
         :return:
         """
-        self._raw_data_dict = self._get_raw_data_dict()
+        # в режиме server аггрегаты получены от сервера, исходные наблюдения не загружаются
+        self._raw_data_dict = self._get_raw_data_dict() if self.__aggregate_by == 'agent' else None
         self.__prices_dict = self.__get_resource_prices()
+        if self.__aggregate_by == 'server':
+            keys, medians, means, max_timestamps = self._parse_aggregate(self._response)
+        elif self.__incremental_state is not None:
+            keys, medians, means, max_timestamps = self.__merge_incremental_state()
+        elif self._aggregation_workers > 1 and len(self._raw_data_dict):
+            keys, medians, means, max_timestamps = self.__aggregate_series_in_processes()
+        elif self._aggregation_engine == 'numpy':
+            keys, medians, means, max_timestamps = self._raw_data_dict.aggregate()
+        else:
+            keys, medians, means, max_timestamps = self.__aggregate_series()
+        max_dates = self._get_dates_from_epoch(max_timestamps)
+        medians = [round(float(median_value), 1) for median_value in medians]
+        means = [round(float(mean_value), 1) for mean_value in means]
+        usage_types, intensivities, decisions = self._classify_usage(medians, means)
         data_dict = {}
-        for command in self._raw_data_dict:
-            for resource_id in self._raw_data_dict[command]:
-                for dimension in self._raw_data_dict[command][resource_id]:
-                    values_list = []
-                    dimension_cost = int(self.__prices_dict[resource_id][dimension])
-                    data_dict.setdefault(command, {}).setdefault(resource_id, {}).setdefault(dimension, {})
-                    for dimension_timestamp in self._raw_data_dict[command][resource_id][dimension]:
-                        values_list.append(
-                            float(self._raw_data_dict[command][resource_id][dimension][dimension_timestamp]))
-                    tmp_dict_for_aggregated_metrics = {}
-                    max_gather_date = max(self._raw_data_dict[command][resource_id][dimension])
-                    max_gather_date = datetime.datetime.strptime(max_gather_date, "%Y-%m-%d %H:%M:%S").date()
-                    median_value = round(float(median(values_list)), 1)
-                    mean_value = round(float(mean(values_list)), 1)
-                    usage_type = self._get_data_usage_type(median_value, mean_value)
-                    intensivity = self._get_data_intensivity(median_value)
-                    decision = self._get_usage_decision(intensivity, usage_type)
-                    if self._debug:
-                        print(f'get_aggregate_data_dict {command}: {resource_id}: {dimension}: '
-                              f'{median_value}, {mean_value}, '
-                              f'{self._DICT_USAGE_TYPE[usage_type]}, '
-                              f'{self._DICT_INTENSIVITY[intensivity]}, '
-                              f'{self._DICT_DECISION[decision]}')
-                    tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_MAX_DATE, max_gather_date)
-                    tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_MEAN, mean_value)
-                    tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_MEDIAN, median_value)
-                    tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_USAGE_TYPE, usage_type)
-                    tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_INTENSIVITY, intensivity)
-                    tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_DECISION, decision)
-                    tmp_dict_for_aggregated_metrics.setdefault(self.__METRIC_DIMENSION_COST, dimension_cost)
-
-                    data_dict[command][resource_id][dimension] = {**tmp_dict_for_aggregated_metrics}
+        for (command, resource_id, dimension), median_value, mean_value, max_gather_date, \
+                usage_type, intensivity, decision in \
+                zip(keys, medians, means, max_dates, usage_types, intensivities, decisions):
+            dimension_cost = int(self.__prices_dict[resource_id][dimension])
+            if self._debug:
+                print(f'get_aggregate_data_dict {command}: {resource_id}: {dimension}: '
+                      f'{median_value}, {mean_value}, '
+                      f'{self._DICT_USAGE_TYPE[usage_type]}, '
+                      f'{self._DICT_INTENSIVITY[intensivity]}, '
+                      f'{self._DICT_DECISION[decision]}')
+            tmp_dict_for_aggregated_metrics = {}
+            tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_MAX_DATE, max_gather_date)
+            tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_MEAN, mean_value)
+            tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_MEDIAN, median_value)
+            tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_USAGE_TYPE, usage_type)
+            tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_INTENSIVITY, intensivity)
+            tmp_dict_for_aggregated_metrics.setdefault(self._METRIC_DECISION, decision)
+            tmp_dict_for_aggregated_metrics.setdefault(self.__METRIC_DIMENSION_COST, dimension_cost)
+
+            data_dict.setdefault(command, {}).setdefault(resource_id, {})[dimension] = \
+                {**tmp_dict_for_aggregated_metrics}
 
         self._aggregated_data_dict = data_dict
         return data_dict
@@ -804,10 +1766,288 @@ class MetricsCollectorAgent:
 #                 trello_connector.add_card(card)
 
 
+class MultiBranchCollector:
+    """
+    Параллельно собирает и аггрегирует данные нескольких филиалов (company_branch) HTTP-источника
+    каждый филиал обрабатывается своим экземпляром MetricsCollectorAgent в пуле потоков,
+    все агенты используют одну http-сессию с общим пулом соединений
+    """
+
+    def __init__(self, server_creds: dict, company_branches):
+        self.__server_creds = server_creds  # общие параметры агентов
+        self.__branch_url = server_creds['branch_url']  # шаблон url данных филиала
+        self.__branch_prices_url = server_creds['branch_prices_url']  # шаблон url стоимости ресурсов филиала
+        self.__branch_aggregate_url = server_creds['branch_aggregate_url']  # шаблон url аггрегатов филиала
+        self.__company_branches = list(company_branches)  # список опрашиваемых филиалов
+        self.__max_workers = server_creds.get('max_workers', 8)  # ограничение количества одновременных запросов
+        self._debug = bool(server_creds.get('debug', 0))
+        self.__http_session = None  # общая http-сессия агентов
+        self._aggregated_data_dict = {}  # результат обработки данных в виде {company_branch: aggregated_data_dict}
+
+    def __enter__(self):
+        """
+        создает общую http-сессию с пулом соединений по количеству одновременно опрашиваемых филиалов
+        :return: возвращает ссылку на себя
+        """
+        self.__http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.__max_workers, pool_maxsize=self.__max_workers)
+        self.__http_session.mount('http://', adapter)
+        self.__http_session.mount('https://', adapter)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__http_session.close()
+        self.__http_session = None
+        print("Сбор данных филиалов завершен") if self._debug else None
+
+    def __collect_branch(self, company_branch):
+        """
+        собирает и аггрегирует данные одного филиала. Выполняется в потоке пула
+        :param company_branch: номер филиала
+        :return: возвращает словарь с аггрегированными данными филиала
+        """
+        branch_creds = {**self.__server_creds,
+                        'server_url': self.__branch_url.format(company_branch=company_branch),
+                        'prices_url': self.__branch_prices_url.format(company_branch=company_branch),
+                        'aggregate_url': self.__branch_aggregate_url.format(company_branch=company_branch)}
+        with MetricsCollectorAgent(branch_creds, http_session=self.__http_session) as agent:
+            return agent.get_aggregated_data_dict()
+
+    def get_aggregated_data_dict(self):
+        """
+        параллельно собирает данные всех филиалов. Разбор и аггрегация данных одного филиала
+        выполняются одновременно с ожиданием ответов сервера по другим филиалам
+        :return: возвращает словарь вида {company_branch: aggregated_data_dict}
+        """
+        data_dict = {}
+        with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+            futures = {executor.submit(self.__collect_branch, company_branch): company_branch
+                       for company_branch in self.__company_branches}
+            for future in as_completed(futures):
+                data_dict[futures[future]] = future.result()
+                print('Данные собраны для филиала:', futures[future]) if self._debug else None
+        self._aggregated_data_dict = {company_branch: data_dict[company_branch]
+                                      for company_branch in self.__company_branches}
+        return self._aggregated_data_dict
+
+
+class PostgresConnectionPool:
+    """
+    Пул соединений с PostgreSQL, общий для агентов с одинаковыми параметрами подключения
+    соединения создаются по мере необходимости и после использования остаются открытыми, поэтому установка
+    соединения и аутентификация не повторяются между запусками и потоками. Одновременно используется
+    не больше maxconn соединений, потоки сверх этого ожидают освобождения соединения
+    перед выдачей соединение, простоявшее дольше health_check_interval секунд, проверяется запросом,
+    разорванное соединение заменяется новым
+    """
+    __pools = {}  # {параметры подключения: пул}
+    __pools_lock = threading.Lock()
+
+    def __init__(self, db_creds: dict, maxconn: int = 10, health_check_interval: float = 30):
+        self.__db_creds = db_creds
+        self.__slots = threading.BoundedSemaphore(maxconn)  # ожидание свободного соединения
+        self.__health_check_interval = health_check_interval
+        self.__idle = deque()  # свободные соединения и время их возврата в пул
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, db_creds: dict, maxconn: int = 10, health_check_interval: float = 30):
+        """
+        возвращает общий пул для параметров подключения, при необходимости создает его
+        :param db_creds: параметры psycopg2.connect
+        :param maxconn: максимальное количество соединений пула
+        :param health_check_interval: время простоя соединения, после которого оно проверяется перед выдачей, секунды
+        :return: экземпляр PostgresConnectionPool
+        """
+        key = tuple(sorted(db_creds.items()))
+        with cls.__pools_lock:
+            connection_pool = cls.__pools.get(key)
+            if connection_pool is None:
+                connection_pool = cls.__pools[key] = cls(db_creds, maxconn, health_check_interval)
+            return connection_pool
+
+    @classmethod
+    def close_all(cls):
+        """
+        закрывает свободные соединения всех общих пулов
+        """
+        with cls.__pools_lock:
+            for connection_pool in cls.__pools.values():
+                connection_pool.close()
+            cls.__pools.clear()
+
+    def close(self):
+        """
+        закрывает свободные соединения пула. Выданные соединения закрываются при возврате
+        """
+        with self.__lock:
+            while self.__idle:
+                self.__idle.pop()[0].close()
+
+    def __is_alive(self, db_conn, released: float):
+        """
+        проверяет соединение, если оно простояло в пуле дольше health_check_interval
+        :param db_conn: свободное соединение
+        :param released: время возврата соединения в пул
+        :return: True, если соединением можно пользоваться
+        """
+        if db_conn.closed:
+            return False
+        if time.monotonic() - released < self.__health_check_interval:
+            return True
+        try:
+            with db_conn.cursor() as db_cursor:
+                db_cursor.execute("select 1")
+            db_conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def __get_connection(self):
+        """
+        возвращает исправное свободное соединение или создает новое
+        последним возвращенное соединение выдается первым, чтобы редко используемые соединения не проверялись зря
+        :return: соединение psycopg2
+        """
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                db_conn, released = self.__idle.pop()
+            if self.__is_alive(db_conn, released):
+                return db_conn
+            db_conn.close()
+        return psycopg2.connect(**self.__db_creds)
+
+    @contextmanager
+    def connection(self, autocommit: bool = False):
+        """
+        выдает соединение на время блока with. Транзакция фиксируется при успешном завершении блока
+        и откатывается при исключении, после чего соединение возвращается в пул
+        :param autocommit: режим autocommit на время блока, например для create index concurrently
+        :return: соединение psycopg2
+        """
+        with self.__slots:
+            db_conn = self.__get_connection()
+            try:
+                db_conn.autocommit = autocommit
+                if autocommit:
+                    # with db_conn открывает транзакцию и в режиме autocommit, поэтому не используется
+                    yield db_conn
+                else:
+                    with db_conn:
+                        yield db_conn
+            finally:
+                # соединение с потерянной связью с сервером закрывается, остальные возвращаются в пул
+                if not db_conn.closed and \
+                        db_conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    if db_conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        db_conn.rollback()
+                    db_conn.autocommit = False
+                    with self.__lock:
+                        self.__idle.append((db_conn, time.monotonic()))
+                else:
+                    db_conn.close()
+
+
 class MetricsCollectorAgentPostgres(MetricsCollectorAgent):
     """
     Собирает и парсит информацию из Базы данных PostgreSQL
     """
+    # запрос аггрегации по всей таблице наблюдений (aggregate_by = database)
+    __AGGREGATE_QUERY = R"""
+                                    select
+                                        r.team,
+                                        r.resource,
+                                        r.dimension,
+                                        max(r.collect_date) as max_date,
+                                        percentile_cont(0.5) within group (order by r.usage) as mediana,
+                                        avg(r.usage) as average
+                                    from
+                                        usage_stats.resources r
+                                    where {filter}
+                                    group by 1, 2, 3
+                                        """
+    # запрос накопленных аггрегатов (aggregate_by = rollup). К накопленным количеству, сумме и гистограмме серии
+    # добавляются наблюдения с id больше учтенной границы, которые еще не попали в таблицы аггрегатов.
+    # Медиана по гистограмме серии: значения с номерами (n - 1) / 2 и n / 2 в порядке возрастания,
+    # как в percentile_cont(0.5). Время запроса зависит от количества серий и новых наблюдений, а не от истории
+    __ROLLUP_QUERY = R"""
+                                    with series_histogram as
+                                    (
+                                    select h.team, h.resource, h.dimension, h.usage, sum(h.observations) as observations
+                                    from
+                                        (
+                                        select r.team, r.resource, r.dimension, r.usage, r.observations
+                                        from usage_stats.resources_histogram r
+                                        where {filter}
+                                        union all
+                                        select r.team, r.resource, r.dimension, r.usage, count(*)
+                                        from usage_stats.resources r
+                                        where r.id > %(last_id)s and {filter}
+                                        group by 1, 2, 3, 4
+                                        ) h
+                                    group by 1, 2, 3, 4
+                                    ), series_rollup as
+                                    (
+                                    select
+                                        ru.team,
+                                        ru.resource,
+                                        ru.dimension,
+                                        sum(ru.observations)::bigint as observations,
+                                        sum(ru.usage_sum) as usage_sum,
+                                        max(ru.max_date) as max_date
+                                    from
+                                        (
+                                        select r.team, r.resource, r.dimension, r.observations, r.usage_sum, r.max_date
+                                        from usage_stats.resources_rollup r
+                                        where {filter}
+                                        union all
+                                        select r.team, r.resource, r.dimension, count(*), sum(r.usage), max(r.collect_date)
+                                        from usage_stats.resources r
+                                        where r.id > %(last_id)s and {filter}
+                                        group by 1, 2, 3
+                                        ) ru
+                                    group by 1, 2, 3
+                                    ), cumulative_histogram as
+                                    (
+                                    select
+                                        h.team,
+                                        h.resource,
+                                        h.dimension,
+                                        h.usage,
+                                        sum(h.observations) over (partition by h.team, h.resource, h.dimension
+                                                                 order by h.usage) as cumulative_observations,
+                                        r.observations
+                                    from
+                                        series_histogram h
+                                        join series_rollup r using (team, resource, dimension)
+                                    ), metrics_medians as
+                                    (
+                                    select
+                                        ch.team,
+                                        ch.resource,
+                                        ch.dimension,
+                                        ((min(ch.usage) filter (where ch.cumulative_observations > (ch.observations - 1) / 2)
+                                          + min(ch.usage) filter (where ch.cumulative_observations > ch.observations / 2))
+                                         / 2.0)::double precision as mediana
+                                    from
+                                        cumulative_histogram ch
+                                    group by 1, 2, 3
+                                    )
+                                    select
+                                        r.team,
+                                        r.resource,
+                                        r.dimension,
+                                        r.max_date,
+                                        mm.mediana,
+                                        r.usage_sum / r.observations as average
+                                    from
+                                        series_rollup r
+                                        join metrics_medians mm using (team, resource, dimension)
+                                        """
+    # выборка новых наблюдений для дополнения накопленных аггрегатов (aggregate_by = rollup)
+    __NEW_ROWS_CONDITION = R"""r.id > %(last_id)s and r.id <= %(new_last_id)s"""
 
     def __init__(self, server_creds: dict, db_creds: dict):
         super().__init__(server_creds)
@@ -818,73 +2058,414 @@ class MetricsCollectorAgentPostgres(MetricsCollectorAgent):
                            'user': db_creds.get('db_user'),
                            'password': db_creds.get('db_password')
                            }
+        # database - аггрегаты вычисляются запросом в БД, rollup - читаются из таблиц накопленных аггрегатов,
+        # agent - исходные наблюдения загружаются в RawDataStore и аггрегируются методом get_aggregated_data_dict
+        self.__aggregate_by = db_creds.get('aggregate_by', 'database')
+        self.__server_cursor = db_creds.get('cursor', 'server') == 'server'  # курсор на стороне сервера БД
+        self.__itersize = db_creds.get('itersize', 2000)  # количество строк, получаемых из БД за раз
+        self.__bootstrap_schema = bool(db_creds.get('bootstrap_schema', 0))
+        self.__partition_months_ahead = db_creds.get('partition_months_ahead', 3)
+        self.__explain_check = bool(db_creds.get('explain_check', 0))
+        self.__rollup_lag = db_creds.get('rollup_lag', 60)
+        # отбор наблюдений для частичного сбора: окно времени [since, until), команды и ресурсы
+        self.__pool = PostgresConnectionPool.shared(self.__db_creds, db_creds.get('pool_maxconn', 10),
+                                                    db_creds.get('pool_health_check_interval', 30))
+        self.__since = db_creds.get('since')
+        self.__until = db_creds.get('until')
+        self.__teams = db_creds.get('teams')
+        self.__resources = db_creds.get('resources')
+        # накопленные аггрегаты не разделены по времени, поэтому с окном времени в режиме rollup
+        # аггрегаты вычисляются запросом к таблице наблюдений
+        self.__use_rollup = self.__aggregate_by == 'rollup' and self.__since is None and self.__until is None
 
     def __enter__(self):
         """
         перегрузка для сбора информации из указанного источника на старте обращения к экземпляру класса
         :return: возвращает ссылку на себя
         """
-        self.__get_data_from_database()
+        if self.__bootstrap_schema:
+            self.bootstrap_schema()
+        if self.__explain_check:
+            self.check_query_plan()
+        if self.__aggregate_by in ('database', 'rollup'):
+            self.__get_data_from_database()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._response = None
         print("Работа парсера завершена") if self._debug else None
 
+    def bootstrap_schema(self):
+        """
+        создает таблицу наблюдений usage_stats.resources, секционированную по месяцам collect_date, если ее нет,
+        секции с месяца самой ранней секции до partition_months_ahead месяцев вперед
+        и индекс серий (team, resource, dimension, collect_date), включающий usage, чтобы группировка по сериям
+        и вычисление медианы выполнялись чтением одного индекса
+        индекс строится без блокировки записи: у секционированной таблицы индекс создается только для самой
+        таблицы (on only), затем concurrently для каждой секции и присоединяется к индексу таблицы
+        существующая несекционированная таблица не преобразуется: для этого нужна миграция данных,
+        для нее создается только индекс, тоже concurrently. Нерабочий индекс, оставшийся от прерванного
+        построения, пересоздается
+        """
+        # create index concurrently нельзя выполнять внутри транзакции
+        with self.__pool.connection(autocommit=True) as db_conn:
+            with db_conn.cursor() as db_cursor:
+                db_cursor.execute(R"""create schema if not exists usage_stats""")
+                db_cursor.execute(R"""
+                                    select c.relkind
+                                    from pg_class c join pg_namespace n on n.oid = c.relnamespace
+                                    where n.nspname = 'usage_stats' and c.relname = 'resources'
+                                        """)
+                table_kind = db_cursor.fetchone()
+                if table_kind is None:
+                    db_cursor.execute(R"""
+                                        create table usage_stats.resources
+                                        (
+                                            id bigserial,
+                                            team text not null,
+                                            resource text not null,
+                                            dimension text not null,
+                                            collect_date timestamp not null,
+                                            usage numeric not null,
+                                            primary key (id, collect_date)
+                                        ) partition by range (collect_date)
+                                            """)
+                    # наблюдения вне созданных секций попадают в секцию по умолчанию
+                    db_cursor.execute(R"""
+                                        create table usage_stats.resources_default
+                                        partition of usage_stats.resources default
+                                            """)
+                    table_kind = ('p',)
+                if table_kind[0] == 'p':
+                    self.__create_partitions(db_cursor)
+                    self.__create_partitions_index(db_cursor)
+                else:
+                    print('Предупреждение: таблица usage_stats.resources не секционирована, '
+                          'секции по collect_date требуют миграции данных')
+                    db_cursor.execute(R"""
+                                        select x.indisvalid
+                                        from pg_index x
+                                        where x.indexrelid = to_regclass('usage_stats.resources_series_idx')
+                                            """)
+                    index_valid = db_cursor.fetchone()
+                    if index_valid is not None and not index_valid[0]:
+                        # прерванное построение concurrently оставляет нерабочий индекс
+                        db_cursor.execute(R"""drop index concurrently usage_stats.resources_series_idx""")
+                    db_cursor.execute(R"""
+                                        create index concurrently if not exists resources_series_idx
+                                        on usage_stats.resources (team, resource, dimension, collect_date)
+                                        include (usage)
+                                            """)
+        print('Схема usage_stats подготовлена') if self._debug else None
+
+    def __create_partitions(self, db_cursor):
+        """
+        создает недостающие секции таблицы наблюдений по месяцам collect_date
+        с месяца самой ранней секции до partition_months_ahead месяцев после текущего
+        первый месяц определяется по границам существующих секций в каталоге, а не по самим наблюдениям,
+        чтобы не читать все секции при каждом запуске
+        :param db_cursor: курсор соединения в режиме autocommit
+        """
+        db_cursor.execute(R"""
+                            select pg_get_expr(c.relpartbound, c.oid)
+                            from pg_inherits i join pg_class c on c.oid = i.inhrelid
+                            where i.inhparent = 'usage_stats.resources'::regclass
+                                """)
+        # границы секций по диапазону: FOR VALUES FROM ('2024-01-01 00:00:00') TO ('2024-02-01 00:00:00'),
+        # у секции по умолчанию граница DEFAULT
+        first_dates = [datetime.date.fromisoformat(match.group(1))
+                       for match in (re.search(r"FROM \('(\d{4}-\d{2}-\d{2})", partition_bound)
+                                     for partition_bound, in db_cursor.fetchall())
+                       if match is not None]
+        first_date = min(first_dates, default=datetime.date.today())
+        month = first_date.year * 12 + first_date.month - 1
+        today = datetime.date.today()
+        last_month = today.year * 12 + today.month - 1 + self.__partition_months_ahead
+        for month_number in range(month, last_month + 1):
+            month_start = datetime.date(month_number // 12, month_number % 12 + 1, 1)
+            month_end = datetime.date((month_number + 1) // 12, (month_number + 1) % 12 + 1, 1)
+            try:
+                db_cursor.execute(R"""
+                                    create table if not exists usage_stats.resources_{0:%Y_%m}
+                                    partition of usage_stats.resources
+                                    for values from ('{0:%Y-%m-%d}') to ('{1:%Y-%m-%d}')
+                                        """.format(month_start, month_end))
+            except psycopg2.Error as error:
+                # секцию нельзя создать, если в секции по умолчанию уже есть наблюдения этого месяца
+                print(f'Предупреждение: не удалось создать секцию за {month_start:%Y-%m}: {error}')
+
+    def __create_partitions_index(self, db_cursor):
+        """
+        создает индекс серий секционированной таблицы наблюдений без блокировки записи на время построения:
+        индекс таблицы создается без индексов секций (on only) и до присоединения индексов всех секций
+        не используется, индекс каждой секции строится concurrently и присоединяется к индексу таблицы
+        секции, созданные после этого, получают индекс автоматически
+        :param db_cursor: курсор соединения в режиме autocommit
+        """
+        db_cursor.execute(R"""
+                            create index if not exists resources_series_idx
+                            on only usage_stats.resources (team, resource, dimension, collect_date)
+                            include (usage)
+                                """)
+        # секции без присоединенного индекса и их индекс с тем же названием, оставшийся от прерванного запуска
+        db_cursor.execute(R"""
+                            select c.relname, x.indisvalid
+                            from pg_inherits i
+                                join pg_class c on c.oid = i.inhrelid
+                                left join pg_class xc on xc.relname = c.relname || '_series_idx'
+                                    and xc.relnamespace = c.relnamespace
+                                left join pg_index x on x.indexrelid = xc.oid
+                            where i.inhparent = 'usage_stats.resources'::regclass
+                                and not exists (
+                                    select
+                                    from pg_index pi join pg_inherits ii on ii.inhrelid = pi.indexrelid
+                                    where pi.indrelid = c.oid
+                                        and ii.inhparent = 'usage_stats.resources_series_idx'::regclass)
+                            order by c.relname
+                                """)
+        for partition_name, index_valid in db_cursor.fetchall():
+            partition = sql.Identifier('usage_stats', partition_name)
+            partition_index = sql.Identifier('usage_stats', partition_name + '_series_idx')
+            if index_valid is False:
+                # прерванное построение concurrently оставляет нерабочий индекс
+                db_cursor.execute(sql.SQL(R"""drop index concurrently {index}""").format(index=partition_index))
+            db_cursor.execute(sql.SQL(R"""
+                                        create index concurrently if not exists {index}
+                                        on {partition} (team, resource, dimension, collect_date)
+                                        include (usage)
+                                            """).format(index=sql.Identifier(partition_name + '_series_idx'),
+                                                        partition=partition))
+            db_cursor.execute(sql.SQL(R"""
+                                        alter index usage_stats.resources_series_idx attach partition {index}
+                                            """).format(index=partition_index))
+            print(f'Индекс секции {partition_name} создан') if self._debug else None
+
+    def check_query_plan(self):
+        """
+        проверяет план основного запроса к таблице наблюдений и выводит предупреждение,
+        если таблица или ее секции читаются последовательно (Seq Scan) - на больших таблицах это означает,
+        что индекс серий отсутствует или не используется
+        в режиме rollup проверяется выборка новых наблюдений по id. В режиме agent и в режиме database
+        без отбора по командам и ресурсам таблица читается целиком, последовательное чтение для них ожидаемо
+        :return: список таблиц, которые читаются последовательно
+        """
+        if self.__aggregate_by == 'agent' or (not self.__use_rollup and not (self.__teams or self.__resources)):
+            return []
+        with self.__pool.connection() as db_conn:
+            with db_conn.cursor() as db_cursor:
+                if self.__use_rollup:
+                    db_cursor.execute(R"""select coalesce(max(id), 0) from usage_stats.resources""")
+                    max_id = db_cursor.fetchone()[0]
+                    db_cursor.execute(R"""explain (format json) select r.id from usage_stats.resources r where """ +
+                                      self.__NEW_ROWS_CONDITION,
+                                      {'last_id': max_id - self.__itersize, 'new_last_id': max_id})
+                else:
+                    query_filter, params = self.__get_filter()
+                    db_cursor.execute(sql.SQL(R"""explain (format json) """ + self.__AGGREGATE_QUERY).format(
+                        filter=query_filter), params)
+                plan = db_cursor.fetchone()[0]
+        seq_scan_tables = []
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan':
+                seq_scan_tables.append(node['Relation Name'])
+            nodes.extend(node.get('Plans', []))
+        if seq_scan_tables:
+            print(f'Предупреждение: запрос читает таблицы последовательно: {", ".join(seq_scan_tables)}. '
+                  f'Проверьте индексы usage_stats.resources (bootstrap_schema)')
+        return seq_scan_tables
+
+    def __get_filter(self, time_window: bool = True):
+        """
+        условие отбора наблюдений таблицы с псевдонимом r по окну времени, командам и ресурсам
+        значения передаются параметрами запроса: условие на collect_date исключает из плана лишние секции,
+        условия на team и resource ограничивают чтение диапазонами индекса серий
+        :param time_window: учитывать окно времени
+        :return: кортеж (условие sql.Composable, параметры запроса)
+        """
+        conditions, params = [], {}
+        if time_window and self.__since is not None:
+            conditions.append(sql.SQL("r.collect_date >= %(since)s"))
+            params['since'] = self.__since
+        if time_window and self.__until is not None:
+            conditions.append(sql.SQL("r.collect_date < %(until)s"))
+            params['until'] = self.__until
+        if self.__teams:
+            conditions.append(sql.SQL("r.team = any(%(teams)s)"))
+            params['teams'] = list(self.__teams)
+        if self.__resources:
+            conditions.append(sql.SQL("r.resource = any(%(resources)s)"))
+            params['resources'] = list(self.__resources)
+        if not conditions:
+            return sql.SQL("true"), params
+        return sql.SQL(" and ").join(conditions), params
+
+    def __get_cursor(self, db_conn, cursor_name: str):
+        """
+        создает курсор для чтения результата запроса порциями
+        именованный курсор хранит результат на сервере БД, поэтому память коллектора не зависит от размера таблицы
+        :param db_conn: соединение с БД
+        :param cursor_name: имя курсора на стороне сервера
+        :return: курсор psycopg2
+        """
+        if self.__server_cursor:
+            db_cursor = db_conn.cursor(name=cursor_name)
+            db_cursor.itersize = self.__itersize
+            return db_cursor
+        return db_conn.cursor()
+
+    def __fetch_batches(self, db_cursor):
+        """
+        генератор порций строк результата запроса
+        :param db_cursor: курсор с выполненным запросом
+        :return: списки строк размером не больше itersize
+        """
+        while True:
+            records = db_cursor.fetchmany(self.__itersize)
+            if not records:
+                break
+            yield records
+
+    def __refresh_rollup(self, db_conn):
+        """
+        дополняет таблицы накопленных аггрегатов наблюдениями до учтенной границы по id
+        по каждой серии (команда, ресурс, измерение) хранятся количество и сумма значений, максимальная дата сбора
+        и гистограмма значений для вычисления медианы
+        id выдаются при вставке, а фиксируются транзакции в другом порядке: строка с меньшим id может стать видна
+        позже строки с большим. Поэтому граница сдвигается в два шага: сначала запоминается последний выданный id
+        последовательности и xmax текущего снимка, затем, когда все транзакции до этого xmax завершены
+        и прошло rollup_lag секунд (транзакция может получить id раньше своего xid), наблюдения до запомненного id
+        учитываются. Наблюдения после учтенной границы аггрегируются запросом __ROLLUP_QUERY
+        последовательность id должна выдавать значения без кэширования в сессиях (cache 1, по умолчанию у bigserial)
+        :param db_conn: соединение с БД. Изменения фиксируются вместе с транзакцией соединения
+        :return: учтенная граница по id
+        """
+        with db_conn.cursor() as db_cursor:
+            # типы столбцов таблиц аггрегатов повторяют типы столбцов таблицы наблюдений
+            db_cursor.execute(R"""
+                                create table if not exists usage_stats.resources_rollup as
+                                select r.team, r.resource, r.dimension,
+                                    0::bigint as observations, 0::numeric as usage_sum, r.collect_date as max_date
+                                from usage_stats.resources r
+                                with no data;
+                                create unique index if not exists resources_rollup_key
+                                    on usage_stats.resources_rollup (team, resource, dimension);
+                                create table if not exists usage_stats.resources_histogram as
+                                select r.team, r.resource, r.dimension, r.usage, 0::bigint as observations
+                                from usage_stats.resources r
+                                with no data;
+                                create unique index if not exists resources_histogram_key
+                                    on usage_stats.resources_histogram (team, resource, dimension, usage);
+                                create table if not exists usage_stats.resources_rollup_state
+                                (
+                                    id integer primary key,
+                                    last_id bigint not null
+                                );
+                                alter table usage_stats.resources_rollup_state
+                                    add column if not exists pending_last_id bigint,
+                                    add column if not exists pending_xmax xid8,
+                                    add column if not exists pending_at timestamptz;
+                                insert into usage_stats.resources_rollup_state values (1, 0)
+                                on conflict (id) do nothing;
+                                    """)
+            # блокировка строки состояния не дает двум агентам учесть одни и те же наблюдения дважды
+            db_cursor.execute(R"""
+                                select
+                                    last_id,
+                                    pending_last_id,
+                                    pending_xmax <= pg_snapshot_xmin(pg_current_snapshot())
+                                        and pending_at <= now() - %s * interval '1 second'
+                                from usage_stats.resources_rollup_state
+                                where id = 1
+                                for update
+                                    """, (self.__rollup_lag,))
+            last_id, pending_last_id, pending_visible = db_cursor.fetchone()
+            if pending_last_id is not None and pending_visible:
+                self.__add_rollup_rows(db_cursor, last_id, pending_last_id)
+                db_cursor.execute(R"""
+                                    update usage_stats.resources_rollup_state
+                                    set last_id = %s, pending_last_id = null, pending_xmax = null, pending_at = null
+                                    where id = 1
+                                        """, (pending_last_id,))
+                last_id, pending_last_id = pending_last_id, None
+            if pending_last_id is None:
+                # последний выданный id, без последовательности - наибольший id в таблице
+                db_cursor.execute(R"""
+                                    select coalesce(pg_sequence_last_value(
+                                                        pg_get_serial_sequence('usage_stats.resources', 'id')::regclass),
+                                                    (select max(id) from usage_stats.resources))
+                                        """)
+                sequence_last_id = db_cursor.fetchone()[0]
+                if sequence_last_id is not None and sequence_last_id > last_id:
+                    # снимок берется отдельным запросом после чтения последовательности: транзакции, получившие
+                    # id до границы, в нем либо завершены, либо меньше его xmax
+                    db_cursor.execute(R"""
+                                        update usage_stats.resources_rollup_state
+                                        set pending_last_id = %s,
+                                            pending_xmax = pg_snapshot_xmax(pg_current_snapshot()),
+                                            pending_at = clock_timestamp()
+                                        where id = 1
+                                            """, (sequence_last_id,))
+        return last_id
+
+    def __add_rollup_rows(self, db_cursor, last_id: int, new_last_id: int):
+        """
+        добавляет к таблицам накопленных аггрегатов наблюдения с id в диапазоне (last_id, new_last_id]
+        :param db_cursor: курсор соединения, в транзакции которого заблокирована строка состояния
+        :param last_id: учтенная граница по id
+        :param new_last_id: новая граница по id
+        """
+        watermark = {'last_id': last_id, 'new_last_id': new_last_id}
+        db_cursor.execute(R"""
+                            insert into usage_stats.resources_histogram as h
+                            select r.team, r.resource, r.dimension, r.usage, count(*)
+                            from usage_stats.resources r
+                            where """ + self.__NEW_ROWS_CONDITION + R"""
+                            group by 1, 2, 3, 4
+                            on conflict (team, resource, dimension, usage)
+                            do update set observations = h.observations + excluded.observations
+                                """, watermark)
+        db_cursor.execute(R"""
+                            insert into usage_stats.resources_rollup as ru
+                            select r.team, r.resource, r.dimension, count(*), sum(r.usage), max(r.collect_date)
+                            from usage_stats.resources r
+                            where """ + self.__NEW_ROWS_CONDITION + R"""
+                            group by 1, 2, 3
+                            on conflict (team, resource, dimension)
+                            do update set observations = ru.observations + excluded.observations,
+                                          usage_sum = ru.usage_sum + excluded.usage_sum,
+                                          max_date = greatest(ru.max_date, excluded.max_date)
+                                """, watermark)
+        print(f'Аггрегаты дополнены наблюдениями с id от {last_id + 1} до {new_last_id}') if self._debug else None
+
     def __get_data_from_database(self):
         """
         Получает из базы набор данных в требуемом формате. Создает словарь с данными для дальнейшей обработки
         :return: ничего не возвращает, хотя надо бы обработать результат(статус) запроса в БД
                 устанавливает переменную self._aggregated_data_dict
         """
-        with psycopg2.connect(**self.__db_creds) as db_conn:
-            with db_conn.cursor() as db_cursor:
-                db_cursor.execute(R"""
-                                    with metrics_raw_data as
-                                    (
-                                    select 
-                                        r.id,
-                                        r.team,
-                                        r.resource,
-                                        r.dimension,
-                                        r.collect_date,
-                                        r.usage
-                                    from
-                                        usage_stats.resources r
-                                    group by 2, 3, 4, 1
-                                    ), metrics_aggregated_data as
-                                    (
-                                    select 
-                                        mrd.team,
-                                        mrd.resource, 
-                                        mrd.dimension,
-                                        max(mrd.collect_date) max_date,
-                                        percentile_cont(0.5) within group (order by mrd.usage) as mediana,
-                                        avg(mrd.usage) as average
-                                    from
-                                        metrics_raw_data mrd
-                                    group by 1, 2, 3
-                                        )
-                                    select 
-                                        mad.team, 
-                                        mad.resource, 
-                                        mad.dimension, 
-                                        mad.max_date,
-                                        mad.mediana,
-                                        mad.average
-                                    from metrics_aggregated_data mad
-                                        """)
+        with self.__pool.connection() as db_conn:
+            if self.__use_rollup:
+                last_id = self.__refresh_rollup(db_conn)
+            with self.__get_cursor(db_conn, 'metrics_aggregated_data') as db_cursor:
+                if self.__use_rollup:
+                    # окно времени к накопленным аггрегатам не применяется, только отбор команд и ресурсов
+                    query_filter, params = self.__get_filter(time_window=False)
+                    params['last_id'] = last_id
+                    db_cursor.execute(sql.SQL(self.__ROLLUP_QUERY).format(filter=query_filter), params)
+                else:
+                    query_filter, params = self.__get_filter()
+                    db_cursor.execute(sql.SQL(self.__AGGREGATE_QUERY).format(filter=query_filter), params)
                 data_dict = {}
-                while True:
-                    team_records = db_cursor.fetchmany(1000)
-                    if not team_records:
-                        break
-                    for record in team_records:
+                for team_records in self.__fetch_batches(db_cursor):
+                    usage_types, intensivities, decisions = \
+                        self._classify_usage([record[4] for record in team_records],
+                                             [record[5] for record in team_records])
+                    for record, usage_type, intensivity, decision in \
+                            zip(team_records, usage_types, intensivities, decisions):
                         tmp_dict = {}
                         team, resource_id, dimension, max_date, dimension_median, dimension_average = record
-                        intensivity = self._get_data_intensivity(dimension_median)
-                        usage_type = self._get_data_usage_type(dimension_median, dimension_average)
-                        decision = self._get_usage_decision(intensivity, usage_type)
                         # print(team, resource_id, dimension, dimension_median, dimension_average)
                         data_dict.setdefault(team, {}).setdefault(resource_id, {}).setdefault(dimension, {})
                         # data_dict[team][resource_id] = data_dict[team].get(resource_id, {})
@@ -910,6 +2491,111 @@ class MetricsCollectorAgentPostgres(MetricsCollectorAgent):
                         data_dict[team][resource_id][dimension] = {**tmp_dict}
                 self._aggregated_data_dict = data_dict
 
+    def _get_raw_data_dict(self):
+        """
+        загружает из базы исходные наблюдения в компактное хранилище RawDataStore
+        используется в режиме aggregate_by = agent
+        :return: возвращает хранилище с записями по каждому событию
+        """
+        # в БД уникальность наблюдения определяется id строки, а не меткой времени
+        raw_data_store = RawDataStore(unique_timestamps=False)
+        with self.__pool.connection() as db_conn:
+            with self.__get_cursor(db_conn, 'metrics_raw_data') as db_cursor:
+                query_filter, params = self.__get_filter()
+                db_cursor.execute(sql.SQL(R"""
+                                    select
+                                        r.team,
+                                        r.resource,
+                                        r.dimension,
+                                        r.collect_date,
+                                        r.usage
+                                    from
+                                        usage_stats.resources r
+                                    where {filter}
+                                        """).format(filter=query_filter), params)
+                for records in self.__fetch_batches(db_cursor):
+                    for team, resource_id, dimension, collect_date, usage in records:
+                        raw_data_store.append(team, resource_id, dimension,
+                                              RawDataStore.datetime_to_epoch(collect_date), float(usage))
+        print('Данные собраны для команд:', raw_data_store.teams()) if self._debug else None
+        return raw_data_store
+
+
+class MetricsCollectorAgentArrow(MetricsCollectorAgent):
+    """
+    Собирает информацию из HTTP-источника в бинарном колоночном формате Arrow IPC (/summary/<branch>.arrow)
+    пакеты записей читаются из потока по мере получения, столбцы меток времени и значений
+    передаются в RawDataStore без разбора текста и без копирования
+    """
+
+    def __init__(self, server_creds: dict, http_session=None):
+        super().__init__(server_creds, http_session)
+        self.__arrow_url = f"{self._request_type}://{server_creds['arrow_url']}"  # url данных в формате Arrow
+        self.__http_response = None  # ответ сервера, из которого читается поток Arrow IPC
+
+    def __enter__(self):
+        """
+        перегрузка для сбора информации из указанного источника на старте обращения к экземпляру класса
+        :return: возвращает ссылку на себя
+        """
+        response = self.http_session.get(self.__arrow_url, headers=self._request_headers, stream=True)
+        if response.status_code != 200:
+            response.close()
+            raise RuntimeError(f"Не удалось получить данные из {self.__arrow_url}. Ошибка: {response.status_code}")
+        # сжатый ответ распаковывается при чтении из response.raw
+        response.raw.decode_content = True
+        self.__http_response = response
+        self._response = pa.ipc.open_stream(response.raw)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.__http_response is not None:
+            self.__http_response.close()
+        self.__http_response = None
+        self._response = None
+        print("Работа парсера завершена") if self._debug else None
+
+    @staticmethod
+    def _get_batch_segments(batch):
+        """
+        разбивает пакет записей Arrow на серии. Серия - непрерывный участок пакета с одинаковыми
+        командой, ресурсом и измерением. Столбцы меток времени и значений не копируются
+        :param batch: пакет записей со столбцами team, resource, dimension, ts, usage
+        :return: кортеж (keys, lengths, timestamps, values), где keys - ключи (team, resource_id, dimension) серий,
+        lengths - количество записей каждой серии, timestamps и values - массивы numpy над буферами пакета
+        """
+        names, codes = [], []
+        for column_name in ('team', 'resource', 'dimension'):
+            column = batch.column(column_name)
+            if not pa.types.is_dictionary(column.type):
+                column = column.dictionary_encode()
+            names.append(column.dictionary.to_pylist())
+            codes.append(column.indices.to_numpy(zero_copy_only=False))
+        timestamps = batch.column('ts').to_numpy()
+        values = batch.column('usage').to_numpy()
+        # начала серий: первая запись пакета и записи, на которых меняется команда, ресурс или измерение
+        starts = np.flatnonzero(np.r_[True, np.any([np.diff(code) != 0 for code in codes], axis=0)])
+        lengths = np.diff(np.r_[starts, len(timestamps)])
+        keys = [(names[0][team_code], names[1][resource_code], names[2][dimension_code])
+                for team_code, resource_code, dimension_code in zip(*(code[starts].tolist() for code in codes))]
+        return keys, lengths, timestamps, values
+
+    def _get_raw_data_dict(self):
+        """
+        загружает пакеты записей Arrow в хранилище RawDataStore по мере чтения ответа сервера
+        столбцы меток времени и значений передаются в хранилище без копирования и аггрегируются
+        прямо над буферами пакетов
+        :return: возвращает хранилище с записями по каждому событию
+        """
+        if self._response is None:
+            return None
+        raw_data_store = RawDataStore()
+        for batch in self._response:
+            if batch.num_rows:
+                raw_data_store.extend_batch(*self._get_batch_segments(batch))
+        print('Данные собраны для команд:', raw_data_store.teams()) if self._debug else None
+        return raw_data_store
+
 
 def main():
     print("Start")
@@ -919,6 +2605,8 @@ def main():
     #    trello.delete_labels_all()
     # with MetricsGenerator(SSH_SERVER_CREDS) as mg:
     #     mg.generate_data_by_ssh()
+    # with MultiBranchCollector(HTTP_SERVER_CREDS, company_branches=range(1, 11)) as multi_branch_collector:
+    #     multi_branch_collector.get_aggregated_data_dict()
     # with MetricsCollectorAgentPostgres(HTTP_SERVER_CREDS, DB_SERVER_CREDS) as mca_postgres_agent:
         # mca_postgres_agent.create_labels_for_teams()
         # mca_postgres_agent.create_cards()
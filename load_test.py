@@ -0,0 +1,69 @@
+"""
+Нагрузочный тест сервера monitoring_module: несколько клиентов параллельно запрашивают данные филиалов
+и читают ответы целиком, как это делает MetricsCollectorAgent
+запуск: python load_test.py [--url http://127.0.0.1:21122] [--path summary] [--branches 1000] ...
+
+Целевая пропускная способность (TARGET_RPS): 30 запросов /summary/<branch>?generator=numpy в секунду на одно ядро
+сервера для 1000 различных филиалов (каждый запрос генерирует набор данных заново) при 8 клиентах и ответах
+без сжатия. Сервер запущен командой python monitoring_module.py --server gunicorn --workers <число ядер> --threads 4,
+для N ядер цель - 30 * N запросов/с (--target-rps). Сжатие gzip уменьшает пропускную способность примерно в 2.5 раза
+"""
+import argparse
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+TARGET_RPS = 30
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервера monitoring_module")
+    parser.add_argument("--url", default="http://127.0.0.1:21122")
+    parser.add_argument("--path", choices=("summary", "aggregate", "prices"), default="summary")
+    parser.add_argument("--query", default="generator=numpy", help="параметры запроса, например profile=x10")
+    parser.add_argument("--branches", type=int, default=1000, help="количество различных филиалов")
+    parser.add_argument("--accept-encoding", default="identity", help="допустимое сжатие ответа, identity - без сжатия")
+    parser.add_argument("--clients", type=int, default=8, help="количество параллельных клиентов")
+    parser.add_argument("--requests", type=int, default=400, help="общее количество запросов")
+    parser.add_argument("--target-rps", type=float, default=TARGET_RPS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    sessions = threading.local()  # у каждого клиента своя сессия с постоянным соединением
+
+    def fetch(request_number: int):
+        session = getattr(sessions, "session", None)
+        if session is None:
+            session = sessions.session = requests.Session()
+            session.headers["Accept-Encoding"] = args.accept_encoding
+        url = f"{args.url}/monitoring/infrastructure/using/{args.path}/{request_number % args.branches + 1}"
+        started = time.perf_counter()
+        with session.get(f"{url}?{args.query}", stream=True) as response:
+            size = sum(len(chunk) for chunk in response.iter_content(chunk_size=65536))
+            return response.status_code, size, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        results = list(executor.map(fetch, range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for _, _, latency in results)
+    errors = sum(status != 200 for status, _, _ in results)
+    rps = len(results) / elapsed
+    print(f"Запросов: {len(results)}, ошибок: {errors}, клиентов: {args.clients}, время: {elapsed:.2f} с")
+    print(f"Пропускная способность: {rps:.1f} запросов/с, "
+          f"{sum(size for _, size, _ in results) / elapsed / 1024 / 1024:.1f} МБ/с")
+    print(f"Задержка: медиана {statistics.median(latencies) * 1000:.0f} мс, "
+          f"95% {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f} мс, максимум {latencies[-1] * 1000:.0f} мс")
+    print(f"Цель {args.target_rps:.0f} запросов/с: {'достигнута' if rps >= args.target_rps and not errors else 'нет'}")
+    return 0 if rps >= args.target_rps and not errors else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,81 +1,753 @@
+import argparse
+import calendar
+import csv
 import datetime
-from collections import deque
+import io
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
 from functools import partial
 import random
-from flask import Flask
+import numpy as np
+from flask import Flask, Response, jsonify, make_response, request
 from faker import Faker
+from werkzeug.serving import WSGIRequestHandler
 import yaml
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
 app = Flask(__name__)
-GENERATED_RESOURCES = []
-SEED = 0
+# филиал, стоимость ресурсов которого отдается по адресу /prices без указания филиала
+DEFAULT_COMPANY_BRANCH = 1
+TEAM_COUNT = 4
+MAX_RESOURCES = 10
+MAX_OBSERVATIONS = 200
+OBSERVATIONS_TYPES = ("CPU", "RAM", "NetFlow")
+TIME_STEP = 3600  # интервал между наблюдениями, секунды
+# ограничение глубины истории наблюдений (max_observations * time_step), секунды: около 50 лет,
+# чтобы время первого наблюдения оставалось в пределах datetime и после начала эпохи
+MAX_HISTORY_SECONDS = 50 * 365 * 24 * 3600
+# профили масштаба набора данных для нагрузочного тестирования (?profile=x10).
+# Отдельные параметры запроса (team_count, max_resources, max_observations, observations_types, time_step)
+# переопределяют значения профиля
+SCALE_PROFILES = {
+    "default": {},
+    "x10": {"max_resources": 100},
+    "x100": {"max_resources": 1000},
+    "x1000": {"max_resources": 10000},
+    "long_history": {"max_observations": 2000},
+}
+# заголовок ответа /summary с меткой времени последнего наблюдения (секунды от начала эпохи, время в UTC).
+# Передается в следующий запрос как ?since=, чтобы получить только более новые наблюдения
+CURSOR_HEADER = "X-Monitoring-Cursor"
+# ограничение размера ответа /summary, байты
+MAX_SUMMARY_BYTES = 4 * 1024 * 1024 * 1024
+# ограничение количества ресурсов филиала (team_count * max_resources): реестр ресурсов и команд
+# генерируется заново для каждого филиала и масштаба, поэтому его размер ограничивается до генерации
+MAX_BRANCH_RESOURCES = 50000
+# наименьшая длина названий ресурсов (Faker license_plate) и команд (Faker bs), байты.
+# Позволяет отклонить слишком большой запрос /summary, не генерируя реестр филиала
+MIN_RESOURCE_NAME_BYTES = 4
+MIN_TEAM_NAME_BYTES = 12
+# ограничение памяти и время хранения сгенерированных наборов данных в кэше
+DATASET_CACHE_MAX_BYTES = 256 * 1024 * 1024
+DATASET_CACHE_TTL = 300
+# ограничение памяти кэша реестров команд и ресурсов филиалов
+BRANCH_REGISTRY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# параметры (alpha, beta) бета-распределений использования ресурсов команд
+DISTRIBUTIONS = ((0.1, 0.1), (1, 3), (8, 8), (1, 1))
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# окончания записей наблюдений для всех возможных значений использования ресурса
+USAGE_RECORD_ENDINGS = [str(usage) + ")" for usage in range(101)]
+# форматы ответа со стоимостью ресурсов. yaml - первый, поэтому используется по умолчанию
+PRICES_MIMETYPES = {"yaml": "application/x-yaml",
+                    "json": "application/json",
+                    "csv": "text/csv"}
+# форматы ответа /summary (?format=dict). text - исходный формат, в котором каждая запись содержит
+# ресурс, измерение и метку времени. dict - название ресурса и измерения, метка времени первого наблюдения
+# и шаг передаются один раз на серию: "resource,dimension,start,step:usage,usage,..."
+SUMMARY_FORMATS = ("text", "dict")
+# заголовок ответа /summary с форматом тела ответа
+FORMAT_HEADER = "X-Monitoring-Format"
+# строковые значения использования ресурса для словарного формата
+USAGE_VALUES = [str(usage) for usage in range(101)]
+# поддерживаемые значения Content-Encoding в порядке предпочтения. zstd доступен при установленном zstandard
+CONTENT_ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# бинарный колоночный формат /summary/<branch>.arrow: поток Arrow IPC, по пакету записей на команду.
+# Названия команды, ресурса и измерения передаются словарем, а в столбцах хранятся только их номера
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+ARROW_SCHEMA = pa.schema([("team", pa.dictionary(pa.int32(), pa.string())),
+                          ("resource", pa.dictionary(pa.int32(), pa.string())),
+                          ("dimension", pa.dictionary(pa.int32(), pa.string())),
+                          ("ts", pa.int64()),
+                          ("usage", pa.uint8())]) if pa is not None else None
+
+
+class DatasetCache:
+    """
+    LRU-кэш сгенерированных наборов данных: закодированный (и сжатый, если клиент поддерживает сжатие) ответ /summary
+    суммарный размер ответов ограничен max_bytes, при превышении вытесняются давно не запрошенные наборы
+    наборы старше ttl секунд не отдаются, чтобы метки времени наблюдений не отставали от текущего времени
+    """
+    def __init__(self, max_bytes: int, ttl: int):
+        self.__max_bytes = max_bytes
+        self.__ttl = ttl
+        self.__datasets = OrderedDict()  # {key: (created_at, body, headers)}
+        self.__size = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        return self.__max_bytes
+
+    def get(self, key):
+        with self.__lock:
+            dataset = self.__datasets.get(key)
+            if dataset is not None and time.monotonic() - dataset[0] > self.__ttl:
+                self.__remove(key)
+                dataset = None
+            if dataset is None:
+                self.__misses += 1
+                return None
+            self.__hits += 1
+            self.__datasets.move_to_end(key)
+            return dataset[1], dataset[2]
+
+    def put(self, key, body: bytes, headers: dict):
+        if len(body) > self.__max_bytes:
+            return
+        with self.__lock:
+            if key in self.__datasets:
+                self.__remove(key)
+            self.__datasets[key] = (time.monotonic(), body, headers)
+            self.__size += len(body)
+            while self.__size > self.__max_bytes:
+                self.__remove(next(iter(self.__datasets)))
+
+    def __remove(self, key):
+        _, body, _ = self.__datasets.pop(key)
+        self.__size -= len(body)
+
+    def stats(self):
+        with self.__lock:
+            return {"hits": self.__hits,
+                    "misses": self.__misses,
+                    "entries": len(self.__datasets),
+                    "bytes": self.__size,
+                    "max_bytes": self.__max_bytes}
+
+
+DATASET_CACHE = DatasetCache(DATASET_CACHE_MAX_BYTES, DATASET_CACHE_TTL)
+
 
+class BranchRegistryCache:
+    """
+    LRU-кэш реестров команд и ресурсов филиалов (get_branch_teams)
+    суммарный размер реестров в памяти ограничен max_bytes, при превышении вытесняются давно не запрошенные реестры
+    """
+    def __init__(self, max_bytes: int):
+        self.__max_bytes = max_bytes
+        self.__registries = OrderedDict()  # {key: (size, teams)}
+        self.__size = 0
+        self.__lock = threading.Lock()
 
-def get_team_resource_using(faker: Faker, observations_conf: dict, max_resources: int = 10):
-    observations = []
-    monitoring_delta = datetime.timedelta(hours=1)
-    time_format = "%Y-%m-%d %H:%M:%S"
+    def get(self, key):
+        with self.__lock:
+            registry = self.__registries.get(key)
+            if registry is None:
+                return None
+            self.__registries.move_to_end(key)
+            return registry[1]
 
-    for _ in range(max_resources):
-        resource = faker.license_plate()
-        GENERATED_RESOURCES.append(resource)
+    def put(self, key, teams: tuple):
+        size = sys.getsizeof(teams) + sum(sys.getsizeof(team) + sys.getsizeof(resources) +
+                                          sum(sys.getsizeof(resource) for resource in resources)
+                                          for team, resources in teams)
+        if size > self.__max_bytes:
+            return
+        with self.__lock:
+            if key in self.__registries:
+                self.__size -= self.__registries.pop(key)[0]
+            self.__registries[key] = (size, teams)
+            self.__size += size
+            while self.__size > self.__max_bytes:
+                self.__size -= self.__registries.pop(next(iter(self.__registries)))[0]
+
+
+BRANCH_REGISTRY_CACHE = BranchRegistryCache(BRANCH_REGISTRY_CACHE_MAX_BYTES)
+
+
+def iter_team_resource_using(faker: Faker, observations_conf: dict, max_resources: int = 10):
+    monitoring_delta = datetime.timedelta(seconds=observations_conf.get("time_step", TIME_STEP))
+
+    # ресурсы и название команды выбираются до генерации наблюдений, чтобы отдать название команды первым.
+    # Faker использует собственный генератор случайных чисел, поэтому порядок вызовов не меняет наблюдения
+    resources = [faker.license_plate() for _ in range(max_resources)]
+    yield faker.bs() + "|"
+
+    # наблюдения с номерами меньше first_observation не старше курсора since: значения для них выбираются,
+    # чтобы последовательность случайных чисел не зависела от since, но в ответ не попадают
+    first_observation = observations_conf.get("first_observation", 0)
+    # в словарном формате серия передается одной записью с меткой времени первого наблюдения и шагом
+    series_header = None
+    if observations_conf.get("summary_format") == "dict":
+        series_header = "," + str(observations_conf["first_epoch"]) + "," + \
+            str(observations_conf.get("time_step", TIME_STEP)) + ":"
+    separator = ""
+    for resource in resources:
+        observations = []
         for observations_type in observations_conf["observations_types"]:
-            observation_datetime = datetime.datetime.now() - datetime.timedelta(
-                hours=observations_conf["max_observations"])
-            for _ in range(observations_conf["max_observations"]):
-                observations.append("(" + ",".join((
-                    resource,
-                    observations_type,
-                    observation_datetime.strftime(time_format),
-                    str(int(observations_conf["distribution"]() * 100))
-                )) + ")")
+            observation_datetime = observations_conf.get("start") or \
+                datetime.datetime.now() - monitoring_delta * observations_conf["max_observations"]
+            usages = []
+            for observation_number in range(observations_conf["max_observations"]):
+                usage = str(int(observations_conf["distribution"]() * 100))
+                if observation_number >= first_observation:
+                    if series_header is not None:
+                        usages.append(usage)
+                    else:
+                        observations.append("(" + ",".join((
+                            resource,
+                            observations_type,
+                            observation_datetime.strftime(TIME_FORMAT),
+                            usage
+                        )) + ")")
                 observation_datetime += monitoring_delta
+            if usages:
+                observations.append(resource + "," + observations_type + series_header + ",".join(usages))
+        if observations:
+            yield separator + ";".join(observations)
+            separator = ";"
+
+
+def iter_team_resource_using_numpy(faker: Faker, observations_conf: dict, max_resources: int = 10):
+    # векторный генератор: наблюдения ресурса по всем измерениям выбираются одним вызовом rng.beta,
+    # метки времени берутся из заранее отформатированной сетки observations_conf["time_grid"]
+    resources = [faker.license_plate() for _ in range(max_resources)]
+    yield faker.bs() + "|"
+
+    observations_types = observations_conf["observations_types"]
+    first_observation = observations_conf.get("first_observation", 0)
+    time_grid = observations_conf["time_grid"][first_observation:]
+    alpha, beta = observations_conf["distribution"]
+    series_header = None
+    if observations_conf.get("summary_format") == "dict":
+        series_header = "," + str(observations_conf["first_epoch"]) + "," + str(observations_conf["time_step"]) + ":"
+    for resource_number, resource in enumerate(resources):
+        usage = (observations_conf["rng"].beta(alpha, beta,
+                                               size=(len(observations_types), observations_conf["max_observations"]))
+                 [:, first_observation:] * 100).astype(np.int64).tolist()
+        if not time_grid:
+            continue
+        if series_header is not None:
+            yield (";" if resource_number else "") + ";".join(
+                resource + "," + observations_type + series_header +
+                ",".join([USAGE_VALUES[observation_usage] for observation_usage in type_usage])
+                for observations_type, type_usage in zip(observations_types, usage))
+            continue
+        yield (";" if resource_number else "") + ";".join(
+            ";".join([prefix + observation_time + USAGE_RECORD_ENDINGS[observation_usage]
+                      for observation_time, observation_usage in zip(time_grid, type_usage)])
+            for prefix, type_usage in zip(("(" + resource + "," + observations_type + ","
+                                           for observations_type in observations_types), usage))
+
+
+def get_branch_teams(company_branch: int, team_count: int = TEAM_COUNT, max_resources: int = MAX_RESOURCES):
+    # реестр команд и ресурсов филиала: повторяет выбор ресурсов и названий команд генератором /summary
+    # с тем же начальным значением, не генерируя наблюдения. Не зависит от предыдущих запросов
+    key = (int(company_branch), team_count, max_resources)
+    teams = BRANCH_REGISTRY_CACHE.get(key)
+    if teams is not None:
+        return teams
+    fake = Faker()
+    fake.seed_instance(int(company_branch))
+    teams = []
+    for _ in range(team_count):
+        resources = tuple(fake.license_plate() for _ in range(max_resources))
+        teams.append((fake.bs(), resources))
+    teams = tuple(teams)
+    BRANCH_REGISTRY_CACHE.put(key, teams)
+    return teams
+
+
+def get_branch_resources(company_branch: int, team_count: int = TEAM_COUNT, max_resources: int = MAX_RESOURCES):
+    return tuple(resource for _, resources in get_branch_teams(company_branch, team_count, max_resources)
+                 for resource in resources)
+
+
+def get_observations_window(max_observations: int, time_step: int = TIME_STEP, since: int = None):
+    # время первого наблюдения, номер первого наблюдения новее курсора since и новый курсор.
+    # Текущее время фиксируется на весь запрос и выравнивается вниз до кратного time_step, поэтому сетка
+    # наблюдений не сдвигается между запросами, а запрос с since=курсор не вернет наблюдений,
+    # пока не пройдет следующий интервал time_step
+    monitoring_delta = datetime.timedelta(seconds=time_step)
+    now = datetime.datetime.now().replace(microsecond=0)
+    now -= datetime.timedelta(seconds=calendar.timegm(now.timetuple()) % time_step)
+    start = now - monitoring_delta * max_observations
+    start_epoch = calendar.timegm(start.timetuple())
+    cursor = start_epoch + time_step * (max_observations - 1)
+    if since is None:
+        return {"start": start, "first_observation": 0, "first_epoch": start_epoch, "cursor": cursor}
+    first_observation = min(max(0, (since - start_epoch) // time_step + 1), max_observations)
+    return {"start": start, "first_observation": first_observation,
+            "first_epoch": start_epoch + time_step * first_observation, "cursor": max(cursor, since)}
+
+
+def get_time_grid(max_observations: int, time_step: int = TIME_STEP, start: datetime.datetime = None):
+    monitoring_delta = datetime.timedelta(seconds=time_step)
+    observation_datetime = start or datetime.datetime.now() - monitoring_delta * max_observations
+    return [(observation_datetime + monitoring_delta * step).strftime(TIME_FORMAT) + ","
+            for step in range(max_observations)]
+
+
+def encode_prices(prices: dict, prices_format: str = "yaml"):
+    if prices_format == "json":
+        return json.dumps({"format": "json", "values": prices}, separators=(",", ":"))
+    elif prices_format == "csv":
+        # компактный табличный формат: заголовок с измерениями, затем по строке на ресурс
+        dimensions = list(next(iter(prices.values()), {}))
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(["resource", *dimensions])
+        writer.writerows([resource, *(resource_prices[dimension] for dimension in dimensions)]
+                         for resource, resource_prices in prices.items())
+        return buffer.getvalue()
+    return yaml.safe_dump({"format": "yaml", "values": prices})
+
+
+def get_prices_format():
+    prices_format = request.args.get("format")
+    if prices_format in PRICES_MIMETYPES:
+        return prices_format
+    best_mimetype = request.accept_mimetypes.best_match(list(PRICES_MIMETYPES.values()), default=None)
+    return {mimetype: name for name, mimetype in PRICES_MIMETYPES.items()}.get(best_mimetype, "yaml")
+
+
+def get_content_encoding():
+    # сжатие ответа по заголовку Accept-Encoding запроса. None - ответ без сжатия
+    return request.accept_encodings.best_match(CONTENT_ENCODINGS, default=None)
+
+
+def iter_compressed(chunks, content_encoding: str):
+    # сжимает части ответа по мере их генерации. Пустые части, пока компрессор накапливает данные, не отдаются
+    if content_encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed_chunk = compressor.compress(chunk)
+        if compressed_chunk:
+            yield compressed_chunk
+    yield compressor.flush()
+
+
+def compress(body: bytes, content_encoding: str):
+    return b"".join(iter_compressed((body,), content_encoding))
+
+
+def get_scale():
+    # параметры масштаба набора данных из профиля и параметров запроса
+    profile = request.args.get("profile", "default")
+    if profile not in SCALE_PROFILES:
+        raise ValueError(f"Unknown profile: {profile}")
+    scale = {"team_count": TEAM_COUNT,
+             "max_resources": MAX_RESOURCES,
+             "max_observations": MAX_OBSERVATIONS,
+             "observations_types": OBSERVATIONS_TYPES,
+             "time_step": TIME_STEP,
+             **SCALE_PROFILES[profile]}
+    for name in ("team_count", "max_resources", "max_observations", "time_step"):
+        scale[name] = int(request.args.get(name, scale[name]))
+        if scale[name] < 1:
+            raise ValueError(f"{name} must be positive")
+    if scale["team_count"] * scale["max_resources"] > MAX_BRANCH_RESOURCES:
+        raise ValueError(f"team_count * max_resources must not exceed {MAX_BRANCH_RESOURCES}")
+    if scale["max_observations"] * scale["time_step"] > MAX_HISTORY_SECONDS:
+        raise ValueError(f"max_observations * time_step must not exceed {MAX_HISTORY_SECONDS} seconds")
+    if "observations_types" in request.args:
+        scale["observations_types"] = tuple(request.args["observations_types"].split(","))
+    if not all(scale["observations_types"]) or any(
+            separator in observations_type for observations_type in scale["observations_types"]
+            for separator in "$|;,():"):
+        raise ValueError("Invalid observations_types")
+    return scale
+
 
-    print(observations)
-    print(observations_conf["distribution"])
-    return faker.bs() + "|" + ";".join(observations)
+def get_summary_bytes(scale: dict, teams_bytes: int, resources_bytes: int):
+    # диапазон размера ответа /summary по суммарной длине названий команд и ресурсов филиала.
+    # Размер записи зависит от числа цифр значения использования (от 0 до 100), поэтому размер дается диапазоном
+    resources = scale["team_count"] * scale["max_resources"]
+    types_count = len(scale["observations_types"])
+    types_bytes = sum(len(observations_type.encode()) for observations_type in scale["observations_types"])
+    observations = resources * types_count * scale["max_observations"]
+    # запись "(" + resource + "," + type + "," + время (19 символов) + "," + usage + ")" и разделитель ";"
+    # без учета названий ресурса и измерения и при однозначном значении usage
+    record_bytes = 1 + 1 + 1 + len(TIME_FORMAT.replace("%Y", "YYYY")) + 1 + 1 + 1 + 1
+    # названия команд и "|", записи команд без последнего ";" и разделители команд "$" без последнего
+    bytes_min = teams_bytes + scale["team_count"] + observations * record_bytes - 1 + \
+        (resources_bytes * types_count + types_bytes * resources) * scale["max_observations"]
+    return bytes_min, bytes_min + observations * 2
+
+
+def get_summary_shape(company_branch: int, scale: dict):
+    # количество записей и размер ответа /summary без генерации наблюдений
+    teams = get_branch_teams(company_branch, scale["team_count"], scale["max_resources"])
+    bytes_min, bytes_max = get_summary_bytes(
+        scale, sum(len(team.encode()) for team, _ in teams),
+        sum(len(resource.encode()) for _, resources in teams for resource in resources))
+    series = len(teams) * scale["max_resources"] * len(scale["observations_types"])
+    return {"teams": len(teams),
+            "resources": len(teams) * scale["max_resources"],
+            "series": series,
+            "observations": series * scale["max_observations"],
+            "bytes_min": bytes_min,
+            "bytes_max": bytes_max,
+            "bytes_limit": MAX_SUMMARY_BYTES}
+
+
+@app.route("/monitoring/infrastructure/using/shape/<int:company_branch>")
+def get_infrastructure_using_shape(company_branch):
+    try:
+        scale = get_scale()
+    except ValueError as error:
+        return str(error), 400
+    return jsonify({**get_summary_shape(company_branch, scale), **scale})
 
 
 @app.route("/monitoring/infrastructure/using/prices")
-def get_infrastructure_using_prices():
-    random.seed(SEED)
+def get_infrastructure_using_prices_default():
+    return get_infrastructure_using_prices(DEFAULT_COMPANY_BRANCH)
+
+
+@app.route("/monitoring/infrastructure/using/prices/<int:company_branch>")
+def get_infrastructure_using_prices(company_branch):
+    # стоимость детерминированно выводится из номера филиала, поэтому обработчик не хранит состояния
+    try:
+        scale = get_scale()
+    except ValueError as error:
+        return str(error), 400
+    prices_random = random.Random(company_branch)
     yaml_prices = {resource: {
-        "CPU": random.randint(10000, 50000),
-        "RAM": random.randint(10000, 50000),
-        "NetFlow": random.randint(10000, 50000),
+        "CPU": prices_random.randint(10000, 50000),
+        "RAM": prices_random.randint(10000, 50000),
+        "NetFlow": prices_random.randint(10000, 50000),
     }
-                   for resource in GENERATED_RESOURCES}
-    return yaml.safe_dump({"format": "yaml", "values": yaml_prices}), 200
+                   for resource in get_branch_resources(company_branch, scale["team_count"], scale["max_resources"])}
+    prices_format = get_prices_format()
+    content_encoding = get_content_encoding()
+    response = make_response(encode_prices(yaml_prices, prices_format), 200)
+    response.mimetype = PRICES_MIMETYPES[prices_format]
+    response.vary.add("Accept")
+    response.vary.add("Accept-Encoding")
+    # ETag позволяет клиенту проверить актуальность своей копии стоимости условным запросом (If-None-Match).
+    # Сжатый ответ - другое представление, поэтому его ETag отличается суффиксом с названием сжатия
+    response.add_etag()
+    if content_encoding is not None:
+        response.set_etag(response.get_etag()[0] + "-" + content_encoding)
+    response = response.make_conditional(request)
+    if content_encoding is not None and response.status_code == 200:
+        response.set_data(compress(response.get_data(), content_encoding))
+        response.headers["Content-Encoding"] = content_encoding
+    return response
 
 
-@app.route("/monitoring/infrastructure/using/summary/<int:company_branch>")
-def get_infrastructure_using_summary(company_branch):
-    GENERATED_RESOURCES.clear()
-    team_count = 4
+def get_team_resource_usage(faker: Faker, observations_conf: dict, max_resources: int = 10):
+    # наблюдения команды массивом использования ресурсов размером (ресурс, измерение, наблюдение).
+    # Случайные значения выбираются в том же порядке, что и в текстовых генераторах, поэтому данные совпадают
+    resources = [faker.license_plate() for _ in range(max_resources)]
+    team = faker.bs()
+    shape = (len(observations_conf["observations_types"]), observations_conf["max_observations"])
+    if "rng" in observations_conf:
+        alpha, beta = observations_conf["distribution"]
+        usage = np.stack([(observations_conf["rng"].beta(alpha, beta, size=shape) * 100).astype(np.uint8)
+                          for _ in resources])
+    else:
+        distribution = observations_conf["distribution"]
+        usage = np.array([int(distribution() * 100) for _ in range(max_resources * shape[0] * shape[1])],
+                         dtype=np.uint8).reshape(max_resources, *shape)
+    return team, resources, usage[:, :, observations_conf.get("first_observation", 0):]
+
+
+def iter_summary_teams(company_branch, generator: str, scale: dict, window: dict, summary_format: str = "text"):
+    # генераторы случайных чисел создаются на каждый запрос, поэтому запросы разных филиалов
+    # могут выполняться одновременно в разных потоках
     SEED = int(company_branch)
-    Faker.seed(SEED)
     fake = Faker()
-    random.seed(SEED)
-
-    team_stats = []
+    fake.seed_instance(SEED)
 
-    distributions = deque((partial(random.betavariate, alpha=0.1, beta=0.1),
-                           partial(random.betavariate, alpha=1, beta=3),
-                           partial(random.betavariate, alpha=8, beta=8),
-                           partial(random.betavariate, alpha=1, beta=1))
-                          )
+    if generator == "numpy":
+        # быстрый режим для нагрузочного тестирования. Данные детерминированы, но отличаются от режима legacy
+        distributions = deque(DISTRIBUTIONS)
+        observations_conf = {"rng": np.random.default_rng(SEED),
+                             "time_grid": get_time_grid(scale["max_observations"], scale["time_step"],
+                                                        window["start"])}
+    else:
+        # режим legacy побайтно совпадает с исходной генерацией через random.betavariate
+        observations_random = random.Random(SEED)
+        distributions = deque(partial(observations_random.betavariate, alpha=alpha, beta=beta)
+                              for alpha, beta in DISTRIBUTIONS)
+        observations_conf = {}
 
-    for _ in range(team_count):
+    # параметры генерации команды отдаются по очереди: наблюдения команды должны быть сгенерированы
+    # до перехода к следующей команде
+    for _ in range(scale["team_count"]):
         distribution = distributions.pop()
-        team_stats.append(get_team_resource_using(fake,
-                                                  observations_conf={
-                                                      "max_observations": 200,
-                                                      "observations_types": ["CPU", "RAM", "NetFlow"],
-                                                      "distribution": distribution
-                                                  }))
+        yield fake, {**observations_conf,
+                     "max_observations": scale["max_observations"],
+                     "observations_types": list(scale["observations_types"]),
+                     "time_step": scale["time_step"],
+                     "start": window["start"],
+                     "first_observation": window["first_observation"],
+                     "first_epoch": window["first_epoch"],
+                     "summary_format": summary_format,
+                     "distribution": distribution}
         distributions.appendleft(distribution)
-    return "$".join(team_stats), 200
+
+
+def iter_infrastructure_using_summary(company_branch, generator: str = "legacy", scale: dict = None,
+                                      window: dict = None, summary_format: str = "text"):
+    scale = {"team_count": TEAM_COUNT,
+             "max_resources": MAX_RESOURCES,
+             "max_observations": MAX_OBSERVATIONS,
+             "observations_types": OBSERVATIONS_TYPES,
+             "time_step": TIME_STEP,
+             **(scale or {})}
+    window = window or get_observations_window(scale["max_observations"], scale["time_step"])
+    team_generator = iter_team_resource_using_numpy if generator == "numpy" else iter_team_resource_using
+    for team_number, (fake, observations_conf) in enumerate(
+            iter_summary_teams(company_branch, generator, scale, window, summary_format)):
+        if team_number:
+            yield "$"
+        yield from team_generator(fake, observations_conf=observations_conf, max_resources=scale["max_resources"])
+
+
+def iter_infrastructure_using_arrow(company_branch, generator: str, scale: dict, window: dict):
+    # поток Arrow IPC: схема, затем пакет записей на каждую команду. Части потока отдаются по мере записи пакетов
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, ARROW_SCHEMA) as writer:
+        for fake, observations_conf in iter_summary_teams(company_branch, generator, scale, window):
+            team, resources, usage = get_team_resource_usage(fake, observations_conf, scale["max_resources"])
+            resources_count, types_count, observations_count = usage.shape
+            timestamps = window["first_epoch"] + scale["time_step"] * np.arange(observations_count, dtype=np.int64)
+            writer.write_batch(pa.record_batch([
+                pa.DictionaryArray.from_arrays(np.zeros(usage.size, dtype=np.int32), [team]),
+                pa.DictionaryArray.from_arrays(
+                    np.repeat(np.arange(resources_count, dtype=np.int32), types_count * observations_count),
+                    resources),
+                pa.DictionaryArray.from_arrays(
+                    np.tile(np.repeat(np.arange(types_count, dtype=np.int32), observations_count), resources_count),
+                    observations_conf["observations_types"]),
+                pa.array(np.tile(timestamps, resources_count * types_count)),
+                pa.array(usage.ravel())], schema=ARROW_SCHEMA))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+
+def get_summary_aggregate(company_branch, generator: str, scale: dict, window: dict):
+    # медиана, среднее и метка времени последнего наблюдения каждой серии (команда, ресурс, измерение),
+    # как в запросе MetricsCollectorAgentPostgres. Наблюдения всех команд аггрегируются одним вызовом numpy
+    teams, usages = [], []
+    for fake, observations_conf in iter_summary_teams(company_branch, generator, scale, window):
+        team, resources, usage = get_team_resource_usage(fake, observations_conf, scale["max_resources"])
+        teams.append((team, resources))
+        usages.append(usage)
+    usage = np.stack(usages)
+    observations_count = usage.shape[-1]
+    medians = np.median(usage, axis=-1).tolist()
+    means = (usage.sum(axis=-1, dtype=np.int64) / observations_count).tolist()
+    max_timestamp = window["first_epoch"] + scale["time_step"] * (observations_count - 1)
+    values = []
+    series_keys = set()
+    for (team, resources), team_medians, team_means in zip(teams, medians, means):
+        for resource, resource_medians, resource_means in zip(resources, team_medians, team_means):
+            for dimension, median, mean in zip(scale["observations_types"], resource_medians, resource_means):
+                # повторяющийся ресурс команды в текстовом формате попадает в ту же серию, в которой
+                # коллектор оставляет первое наблюдение на метку времени, поэтому учитывается первое вхождение
+                if (team, resource, dimension) in series_keys:
+                    continue
+                series_keys.add((team, resource, dimension))
+                values.append([team, resource, dimension, median, mean, max_timestamp])
+    return {"format": "aggregate",
+            "columns": ["team", "resource", "dimension", "median", "mean", "max_ts"],
+            "values": values}
+
+
+def iter_and_cache_summary(key, chunks, headers: dict):
+    # отдает закодированные части ответа по мере генерации и одновременно собирает их для кэша,
+    # пока размер ответа не превысил ограничение кэша
+    encoded_chunks = []
+    encoded_size = 0
+    for encoded_chunk in chunks:
+        if encoded_chunks is not None:
+            encoded_chunks.append(encoded_chunk)
+            encoded_size += len(encoded_chunk)
+            if encoded_size > DATASET_CACHE.max_bytes:
+                encoded_chunks = None
+        yield encoded_chunk
+    if encoded_chunks is not None:
+        DATASET_CACHE.put(key, b"".join(encoded_chunks), headers)
+
+
+def make_summary_response(company_branch, summary_format: str):
+    # generator=numpy - векторная генерация наблюдений, по умолчанию - исходная (legacy)
+    generator = request.args.get("generator", "legacy")
+    try:
+        scale = get_scale()
+    except ValueError as error:
+        return str(error), 400
+    # сначала размер оценивается по наименьшей длине названий, чтобы не генерировать реестр филиала
+    # для заведомо слишком большого ответа, затем проверяется точно
+    _, bytes_max = get_summary_bytes(scale, MIN_TEAM_NAME_BYTES * scale["team_count"],
+                                     MIN_RESOURCE_NAME_BYTES * scale["team_count"] * scale["max_resources"])
+    if bytes_max <= MAX_SUMMARY_BYTES:
+        bytes_max = get_summary_shape(company_branch, scale)["bytes_max"]
+    if bytes_max > MAX_SUMMARY_BYTES:
+        return f"Summary size up to {bytes_max} bytes exceeds limit of {MAX_SUMMARY_BYTES} bytes", 413
+    # since - курсор из заголовка X-Monitoring-Cursor предыдущего ответа: отдать только более новые наблюдения
+    since = request.args.get("since", type=int)
+    content_encoding = get_content_encoding()
+    window = get_observations_window(scale["max_observations"], scale["time_step"], since)
+    # курсор в ключе: с началом следующего интервала time_step сетка наблюдений сдвигается и набор устаревает
+    key = (company_branch, generator, summary_format, content_encoding, window["cursor"], *scale.values())
+    if since is None:
+        dataset = DATASET_CACHE.get(key)
+        if dataset is not None:
+            body, headers = dataset
+            return Response(body, 200, headers)
+    headers = {CURSOR_HEADER: str(window["cursor"]), FORMAT_HEADER: summary_format, "Vary": "Accept-Encoding"}
+    # ответ отдается по частям (команда за командой, ресурс за ресурсом) по мере генерации
+    if summary_format == "arrow":
+        headers["Content-Type"] = ARROW_MIMETYPE
+        chunks = iter_infrastructure_using_arrow(company_branch, generator, scale, window)
+    else:
+        chunks = (chunk.encode() for chunk in
+                  iter_infrastructure_using_summary(company_branch, generator, scale, window, summary_format))
+    if content_encoding is not None:
+        headers["Content-Encoding"] = content_encoding
+        chunks = iter_compressed(chunks, content_encoding)
+    if since is None:
+        chunks = iter_and_cache_summary(key, chunks, headers)
+    return Response(chunks, 200, headers)
+
+
+@app.route("/monitoring/infrastructure/using/summary/<int:company_branch>")
+def get_infrastructure_using_summary(company_branch):
+    summary_format = request.args.get("format", "text")
+    if summary_format not in SUMMARY_FORMATS:
+        return f"Unknown format: {summary_format}", 400
+    return make_summary_response(company_branch, summary_format)
+
+
+@app.route("/monitoring/infrastructure/using/summary/<int:company_branch>.arrow")
+def get_infrastructure_using_summary_arrow(company_branch):
+    if pa is None:
+        return "Arrow format requires pyarrow", 501
+    return make_summary_response(company_branch, "arrow")
+
+
+@app.route("/monitoring/infrastructure/using/aggregate/<int:company_branch>")
+def get_infrastructure_using_aggregate(company_branch):
+    # аггрегаты серий вместо исходных наблюдений. Параметры generator и масштаба те же, что у /summary
+    generator = request.args.get("generator", "legacy")
+    try:
+        scale = get_scale()
+    except ValueError as error:
+        return str(error), 400
+    content_encoding = get_content_encoding()
+    window = get_observations_window(scale["max_observations"], scale["time_step"])
+    key = (company_branch, generator, "aggregate", content_encoding, window["cursor"], *scale.values())
+    dataset = DATASET_CACHE.get(key)
+    if dataset is not None:
+        body, headers = dataset
+        return Response(body, 200, headers)
+    body = json.dumps(get_summary_aggregate(company_branch, generator, scale, window),
+                      separators=(",", ":")).encode()
+    headers = {CURSOR_HEADER: str(window["cursor"]), "Content-Type": "application/json", "Vary": "Accept-Encoding"}
+    if content_encoding is not None:
+        headers["Content-Encoding"] = content_encoding
+        body = compress(body, content_encoding)
+    DATASET_CACHE.put(key, body, headers)
+    return Response(body, 200, headers)
+
+
+@app.route("/monitoring/infrastructure/using/cache")
+def get_dataset_cache_stats():
+    return jsonify(DATASET_CACHE.stats())
+
+
+# Запуск сервера. Отладочный сервер Flask (--server flask) обрабатывает запросы в одном процессе, поэтому
+# для нагрузочного тестирования коллектора используется waitress (несколько потоков в одном процессе)
+# или gunicorn (несколько процессов с потоками, только для POSIX):
+#   python monitoring_module.py --server gunicorn --workers 4 --threads 4 --keep-alive 75
+# либо напрямую: gunicorn -w 4 -k gthread --threads 4 --keep-alive 75 -b 127.0.0.1:21122 monitoring_module:app
+# генераторы случайных чисел создаются на каждый запрос, поэтому процессы и потоки не разделяют состояние генерации.
+# Кэш наборов данных DATASET_CACHE и реестр ресурсов филиалов у каждого процесса свои
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сервер данных мониторинга использования ресурсов")
+    # MetricsGenerator запускает сервер командой "monitoring_module 1": филиал передается в запросах,
+    # поэтому позиционный аргумент принимается для совместимости и не используется
+    parser.add_argument("company_branch", nargs="?", help="не используется, оставлен для совместимости")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=21122)
+    parser.add_argument("--server", choices=("flask", "waitress", "gunicorn"), default="flask",
+                        help="flask - отладочный сервер, waitress и gunicorn - серверы для нагрузки")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="количество процессов gunicorn")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="количество потоков обработки запросов в каждом процессе")
+    parser.add_argument("--keep-alive", type=int, default=75,
+                        help="сколько секунд держать открытым неактивное соединение клиента")
+    return parser.parse_args(argv)
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class MonitoringApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("keepalive", args.keep_alive)
+
+        def load(self):
+            return app
+
+    MonitoringApplication().run()
+
+
+def main(argv=None):
+    args = get_args(argv)
+    if args.server == "gunicorn":
+        run_gunicorn(args)
+    elif args.server == "waitress":
+        import waitress
+        waitress.serve(app, host=args.host, port=args.port, threads=args.threads, channel_timeout=args.keep_alive)
+    else:
+        # HTTP/1.1 позволяет клиенту переиспользовать соединение и с отладочным сервером
+        WSGIRequestHandler.protocol_version = "HTTP/1.1"
+        app.run(host=args.host, port=args.port, threaded=True)
 
 
 if __name__ == '__main__':
-    app.run(port=21122)
+    main()
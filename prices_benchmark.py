@@ -0,0 +1,45 @@
+"""
+Замер времени разбора ответа со стоимостью ресурсов в разных форматах (yaml, json, csv)
+формирует ответы так же, как сервер monitoring_module, и разбирает их так же, как MetricsCollectorAgent
+запуск: python prices_benchmark.py [количество ресурсов, по умолчанию 100000]
+"""
+import importlib.util
+import random
+import sys
+import time
+from pathlib import Path
+
+from monitoring_module import PRICES_MIMETYPES, encode_prices
+
+
+def load_collector_module():
+    """
+    загружает модуль коллектора 5.5.py, имя которого не позволяет импортировать его обычным образом
+    """
+    spec = importlib.util.spec_from_file_location("collector", Path(__file__).with_name("5.5.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main(resources_count: int):
+    parse_prices = load_collector_module().MetricsCollectorAgent._parse_prices
+    random.seed(0)
+    prices = {f"RES-{resource:07d}": {"CPU": random.randint(10000, 50000),
+                                      "RAM": random.randint(10000, 50000),
+                                      "NetFlow": random.randint(10000, 50000)}
+              for resource in range(resources_count)}
+    print(f"Ресурсов: {resources_count}")
+    print("|format\t|size, KB\t|encode, s\t|parse, s")
+    for prices_format, mimetype in PRICES_MIMETYPES.items():
+        started = time.perf_counter()
+        body = encode_prices(prices, prices_format)
+        encoded = time.perf_counter()
+        parsed = parse_prices(body, mimetype)
+        finished = time.perf_counter()
+        assert parsed == prices, f"Формат {prices_format} разобран с ошибками"
+        print(f"|{prices_format}\t|{len(body.encode()) // 1024}\t\t|{encoded - started:.3f}\t\t|{finished - encoded:.3f}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
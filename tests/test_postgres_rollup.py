@@ -0,0 +1,124 @@
+"""
+проверка накопленных аггрегатов MetricsCollectorAgentPostgres (aggregate_by = rollup)
+нужна отдельная БД PostgreSQL 13+, схема usage_stats в ней пересоздается:
+MONITORING_TEST_DB="host=localhost port=5432 dbname=monitoring_test user=postgres password=..." python -m unittest
+"""
+import importlib.util
+import os
+import pathlib
+import unittest
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+TEST_DSN = os.environ.get('MONITORING_TEST_DB')
+
+
+def load_collector():
+    """
+    загружает модуль коллектора 5.5.py, имя которого нельзя импортировать напрямую
+    :return: модуль коллектора
+    """
+    path = pathlib.Path(__file__).resolve().parent.parent / '5.5.py'
+    spec = importlib.util.spec_from_file_location('collector', path)
+    collector = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(collector)
+    return collector
+
+
+@unittest.skipIf(psycopg2 is None or not TEST_DSN, 'не задана тестовая БД MONITORING_TEST_DB')
+class RollupWatermarkTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.collector = load_collector()
+        dsn = psycopg2.extensions.parse_dsn(TEST_DSN)
+        cls.db_creds = {**cls.collector.DB_SERVER_CREDS,
+                        'db_host': dsn.get('host'),
+                        'db_port': dsn.get('port', 5432),
+                        'db_base': dsn.get('dbname'),
+                        'db_user': dsn.get('user'),
+                        'db_password': dsn.get('password'),
+                        'bootstrap_schema': 0,
+                        'explain_check': 0,
+                        'rollup_lag': 0}
+
+    def setUp(self):
+        self.db_conn = psycopg2.connect(TEST_DSN)
+        self.db_conn.autocommit = True
+        with self.db_conn.cursor() as db_cursor:
+            db_cursor.execute("""
+                                drop schema if exists usage_stats cascade;
+                                create schema usage_stats;
+                                create table usage_stats.resources
+                                (
+                                    id bigserial primary key,
+                                    team text not null,
+                                    resource text not null,
+                                    dimension text not null,
+                                    collect_date timestamp not null,
+                                    usage numeric not null
+                                );
+                                insert into usage_stats.resources (team, resource, dimension, collect_date, usage)
+                                select 'team' || g % 3, 'resource' || g % 7, 'CPU',
+                                    '2026-01-01'::timestamp + g * interval '1 hour', g % 100
+                                from generate_series(1, 500) g;
+                                  """)
+
+    def tearDown(self):
+        self.db_conn.close()
+
+    def collect(self, aggregate_by: str) -> dict:
+        """
+        собирает аггрегаты агентом с указанным режимом аггрегации
+        :param aggregate_by: database или rollup
+        :return: словарь аггрегатов {команда: {ресурс: {измерение: {метрика: значение}}}}
+        """
+        agent = self.collector.MetricsCollectorAgentPostgres({**self.collector.HTTP_SERVER_CREDS, 'debug': 0},
+                                                             {**self.db_creds, 'aggregate_by': aggregate_by})
+        with agent:
+            return agent._aggregated_data_dict
+
+    def query(self, query: str):
+        with self.db_conn.cursor() as db_cursor:
+            db_cursor.execute(query)
+            return db_cursor.fetchone()
+
+    def insert_row(self, db_conn, usage: int) -> int:
+        with db_conn.cursor() as db_cursor:
+            db_cursor.execute("""
+                                insert into usage_stats.resources (team, resource, dimension, collect_date, usage)
+                                values ('team0', 'resource0', 'CPU', '2026-03-01', %s)
+                                returning id
+                                  """, (usage,))
+            return db_cursor.fetchone()[0]
+
+    def test_row_committed_out_of_id_order_is_counted(self):
+        self.assertEqual(self.collect('rollup'), self.collect('database'))
+        # строка с меньшим id фиксируется позже строки с большим id
+        late_conn = psycopg2.connect(TEST_DSN)
+        try:
+            late_id = self.insert_row(late_conn, 1000)
+            early_id = self.insert_row(self.db_conn, 2000)
+            self.assertLess(late_id, early_id)
+            self.assertEqual(self.collect('rollup'), self.collect('database'))
+            self.assertEqual(self.collect('rollup'), self.collect('database'))
+            late_conn.commit()
+        finally:
+            late_conn.close()
+        for _ in range(3):
+            self.assertEqual(self.collect('rollup'), self.collect('database'))
+        last_id, = self.query("select last_id from usage_stats.resources_rollup_state")
+        self.assertGreaterEqual(last_id, early_id)
+        # каждое наблюдение учтено в накопленных аггрегатах ровно один раз
+        self.assertEqual(self.query("select sum(observations) from usage_stats.resources_rollup"),
+                         self.query("select count(*) from usage_stats.resources"))
+        self.assertEqual(self.query("select sum(observations) from usage_stats.resources_histogram"),
+                         self.query("select count(*) from usage_stats.resources"))
+
+
+if __name__ == '__main__':
+    unittest.main()